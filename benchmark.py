@@ -0,0 +1,359 @@
+"""
+Benchmarks for cluster.py. Run as a script:
+
+    python benchmark.py --rows 1000 100000 --dims 3 8 --output results.json
+
+to generate synthetic lifting/nutrition .csv files of each size and time every stage of the pipeline on them (loading
+the .csv, seeding, clustering, rendering and predicting), with the peak memory of each stage. The results are written
+as JSON so that runs can be compared. Pass --compare-seeding to compare how many iterations create_clusters needs to
+converge from each of the seeding methods in pick_initial_centroids, --compare-precision to compare clustering
+float64 and compact float32 points, or --compare-coreset to compare the approximate coreset_clusters with an exact fit.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from cluster import (CORESET_METHODS, SEEDING_METHODS, ClusterModel, assign_points, beautify_data, build_column_cache,
+                     build_point_list, coreset_clusters, create_clusters, load_points, pick_initial_centroids,
+                     visualize_clusters)
+
+# the columns of bulkData.csv with a typical mean and spread for each; wider data sets add generic columns
+LIFTING_COLUMNS = [('Calories', 2800, 500), ('FAT (g)', 180, 50), ('CHO (g)', 160, 50), ('PRO (g)', 175, 40),
+                   ('Water (oz)', 95, 20), ('Expected Volume (reps*sets*lbs)', 5300, 700),
+                   ('Actual Volume (reps*sets*lbs)', 5200, 900), ('Work Fraction', 0.97, 0.12)]
+
+# the legacy beautify_data/build_point_list loader is skipped above this many rows; it holds every value as a Python
+# object twice and would take hours on the largest data sets
+LEGACY_LOAD_MAX_ROWS = 1000000
+
+STAGES = ('legacy_load', 'load', 'cached_load', 'seed', 'cluster', 'render', 'predict')
+
+
+def make_blobs(num_points, dimensions, k, seed=0):
+    """
+    Makes a synthetic data set of k Gaussian blobs with random centers, for benchmarking.
+    :param: num_points : the total number of points
+    :param: dimensions : the number of dimensions of each point
+    :param: k : the number of blobs
+    :param: seed : the seed for the random generator
+    :return: an (num_points, dimensions) float64 array of points
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-10, 10, size=(k, dimensions))
+    labels = rng.integers(0, k, size=num_points)
+    return centers[labels] + rng.normal(size=(num_points, dimensions))
+
+
+def lifting_columns(dimensions):
+    """
+    The column names, means and spreads of a synthetic data set with the given number of dimensions: the bulkData.csv
+    columns first, then generic 'Metric n' columns.
+    :return: a list of (name, mean, spread) tuples
+    """
+    columns = LIFTING_COLUMNS[:dimensions]
+    columns += [(f'Metric {i}', 100, 25) for i in range(len(columns), dimensions)]
+    return columns
+
+
+def write_lifting_csv(path, num_rows, dimensions, k=8, seed=0, chunk_rows=100000):
+    """
+    Writes a synthetic lifting/nutrition .csv in the same layout as bulkData.csv (a header row and a trailing comma on
+    every line). The rows come from k groups of training days, each shifted from the column means by up to one spread,
+    so the data has some cluster structure. Rows are generated and written chunk_rows at a time.
+    :param: path : the file to write
+    :param: num_rows : the number of data rows
+    :param: dimensions : the number of columns
+    :param: k : the number of groups
+    :param: seed : the seed for the random generator
+    :param: chunk_rows : the number of rows generated at a time
+    :return: the list of column names
+    """
+    rng = np.random.default_rng(seed)
+    columns = lifting_columns(dimensions)
+    means = np.array([mean for _, mean, _ in columns])
+    spreads = np.array([spread for _, _, spread in columns])
+    centers = means + rng.uniform(-1, 1, size=(k, dimensions)) * spreads
+
+    with open(path, 'w') as fp:
+        fp.write(','.join(name for name, _, _ in columns) + ',\n')
+        for start in range(0, num_rows, chunk_rows):
+            rows = min(chunk_rows, num_rows - start)
+            block = centers[rng.integers(0, k, size=rows)] + rng.normal(size=(rows, dimensions)) * spreads / 3
+            np.savetxt(fp, np.abs(block), fmt='%.4f', delimiter=',', newline=',\n')
+    return [name for name, _, _ in columns]
+
+
+def measure(func, *args, **kwargs):
+    """
+    Calls func and measures its wall time and the peak memory it allocated (as seen by tracemalloc, which NumPy
+    reports its array buffers to).
+    :return: result, seconds, peak_bytes
+    """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def _legacy_load(path, columns):
+    """
+    The original loading path: beautify_data followed by build_point_list.
+    """
+    with open(path) as fp:
+        data = beautify_data(fp)
+    return build_point_list({name: data[name] for name in columns})
+
+
+def bench_pipeline(path, columns, k, iterations=100, seed=0, stages=STAGES, render_max_points=100000):
+    """
+    Times each stage of the clustering pipeline on one .csv file.
+    :param: path : the .csv file
+    :param: columns : the columns to cluster on
+    :param: k : the number of clusters
+    :param: iterations : the iteration cap passed to create_clusters
+    :param: seed : the seed for the seeding
+    :param: stages : the stages (from STAGES) to run; load, seed and cluster always run since later stages need them
+    :param: render_max_points : the number of points drawn by the render stage
+    :return: a dict mapping each stage to a dict of its 'seconds', 'peak_bytes' and stage specific values
+    """
+    results = {}
+    if 'legacy_load' in stages:
+        _, seconds, peak = measure(_legacy_load, path, columns)
+        results['legacy_load'] = {'seconds': seconds, 'peak_bytes': peak}
+
+    (points, _), seconds, peak = measure(load_points, path, columns)
+    results['load'] = {'seconds': seconds, 'peak_bytes': peak}
+
+    if 'cached_load' in stages:
+        _, seconds, peak = measure(build_column_cache, path)
+        results['cache_build'] = {'seconds': seconds, 'peak_bytes': peak}
+        _, seconds, peak = measure(load_points, path, columns, cache=True)
+        results['cached_load'] = {'seconds': seconds, 'peak_bytes': peak}
+
+    initial, seconds, peak = measure(pick_initial_centroids, k, points, method='kmeans++', seed=seed)
+    results['seed'] = {'seconds': seconds, 'peak_bytes': peak}
+
+    (centrds, clusters, history), seconds, peak = measure(create_clusters, k, initial, points, iterations,
+                                                          return_history=True)
+    results['cluster'] = {'seconds': seconds, 'peak_bytes': peak, 'iterations': len(history),
+                          'seconds_per_iteration': float(np.mean([record['time'] for record in history])),
+                          'inertia': history[-1]['inertia']}
+
+    if 'render' in stages and points.shape[1] >= 3:
+        with tempfile.TemporaryDirectory() as tmp:
+            _, seconds, peak = measure(visualize_clusters, centrds[:, :3], clusters, points[:, :3], columns[:3],
+                                       sphere=True, save_path=os.path.join(tmp, 'render.png'),
+                                       max_points=render_max_points, seed=seed)
+        results['render'] = {'seconds': seconds, 'peak_bytes': peak, 'max_points': render_max_points}
+
+    if 'predict' in stages:
+        results['predict'] = bench_predict(ClusterModel(centrds, columns), points)
+
+    return results
+
+
+def bench_seeding(points, k, runs=10, max_iterations=300):
+    """
+    Runs create_clusters to convergence from runs differently seeded starts for every seeding method.
+    :param: points : an (n, d) array of points
+    :param: k : the number of clusters
+    :param: runs : the number of seeds to try for each method
+    :param: max_iterations : the iteration cap passed to create_clusters
+    :return: a list of dicts, one per method, with the mean iterations, seeding time, total time and final inertia
+    """
+    results = []
+    for method in SEEDING_METHODS:
+        iterations, seed_times, total_times, inertias = [], [], [], []
+        for seed in range(runs):
+            start = time.perf_counter()
+            initial = pick_initial_centroids(k, points, method=method, seed=seed)
+            seeded = time.perf_counter()
+            _, _, history = create_clusters(k, initial, points, max_iterations, return_history=True)
+            done = time.perf_counter()
+
+            iterations.append(len(history))
+            seed_times.append(seeded - start)
+            total_times.append(done - start)
+            inertias.append(history[-1]['inertia'])
+
+        results.append({'method': method, 'iterations': float(np.mean(iterations)),
+                        'seed_time': float(np.mean(seed_times)), 'total_time': float(np.mean(total_times)),
+                        'inertia': float(np.mean(inertias))})
+    return results
+
+
+def bench_predict(model, points, repeats=5):
+    """
+    Times a save/load round trip of a ClusterModel and its predict throughput.
+    :param: model : a ClusterModel
+    :param: points : an (n, d) array of points to label
+    :param: repeats : predict is timed this many times and the best time kept
+    :return: a dict with the 'load_time' in seconds and the predict 'rows_per_second'
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model.npz')
+        model.save(path)
+        start = time.perf_counter()
+        model = ClusterModel.load(path)
+        load_time = time.perf_counter() - start
+
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict(points)
+        best = min(best, time.perf_counter() - start)
+    return {'load_time': load_time, 'rows_per_second': len(points) / best}
+
+
+def bench_precision(points, k, max_iterations=300, seed=0):
+    """
+    Fits the same data stored in float64 and in float32, from the same initial centroids, and reports the memory saved
+    and any difference in the result.
+    :param: points : an (n, d) float64 array of points
+    :param: k : the number of clusters
+    :param: max_iterations : the iteration cap passed to create_clusters
+    :param: seed : the seed for the initial centroids
+    :return: a dict with the bytes each representation of the points takes ('list_bytes' is an estimate for the list of
+             lists of floats made by build_point_list), each fit's time, the fraction of points given the same label,
+             and the largest relative difference of the centroids and of the inertia
+    """
+    initial = pick_initial_centroids(k, points, method='kmeans++', seed=seed)
+    results = {'list_bytes': points.size * 24 + len(points) * (56 + 8 * points.shape[1])}
+    fits = {}
+    for dtype in (np.float64, np.float32):
+        stored = points.astype(dtype)
+        start = time.perf_counter()
+        centrds, clusters, history = create_clusters(k, initial, stored, max_iterations, return_history=True)
+        name = np.dtype(dtype).name
+        results[f'{name}_bytes'] = stored.nbytes
+        results[f'{name}_seconds'] = time.perf_counter() - start
+        fits[name] = (centrds, assign_points(points, centrds)[0], history[-1]['inertia'])
+
+    (c64, l64, i64), (c32, l32, i32) = fits['float64'], fits['float32']
+    results['label_agreement'] = float(np.mean(l64 == l32))
+    results['centroid_rel_diff'] = float(np.abs(c64 - c32).max() / np.abs(c64).max())
+    results['inertia_rel_diff'] = abs(i64 - i32) / i64
+    return results
+
+
+def bench_coreset(points, k, sizes=(1000, 5000, 20000), max_iterations=300, max_ratio=1.05, seed=0):
+    """
+    Fits the points exactly with create_clusters (from k-means++ seeding) and approximately with coreset_clusters for
+    each coreset method and size, and reports the accuracy against the speedup of each approximate fit.
+    :param: points : an (n, d) float64 array of points
+    :param: k : the number of clusters
+    :param: sizes : the coreset sizes to try
+    :param: max_iterations : the iteration cap for both fits
+    :param: max_ratio : the bound on the approximate inertia as a multiple of the exact inertia
+    :param: seed : the seed for both fits
+    :return: a list of dicts, one per approximate fit, with its 'method', 'size', 'seconds', 'speedup' over the exact
+             fit, 'inertia_ratio' to the exact inertia, and whether the ratio is 'within_bound'
+    """
+    start = time.perf_counter()
+    initial = pick_initial_centroids(k, points, method='kmeans++', seed=seed)
+    centrds, _ = create_clusters(k, initial, points, max_iterations)
+    exact_seconds = time.perf_counter() - start
+    exact_inertia = float(assign_points(points, centrds)[1].sum())
+
+    rows = []
+    for method in CORESET_METHODS:
+        for size in sizes:
+            start = time.perf_counter()
+            _, _, report = coreset_clusters(k, points, size, max_iterations, method=method, seed=seed)
+            seconds = time.perf_counter() - start
+            ratio = report['inertia'] / exact_inertia
+            rows.append({'method': method, 'size': size, 'seconds': seconds, 'speedup': exact_seconds / seconds,
+                         'inertia_ratio': ratio, 'within_bound': ratio <= max_ratio})
+    return rows
+
+
+def run_suite(rows, dims, k, iterations, stages, data_dir, render_max_points):
+    """
+    Runs bench_pipeline on a generated data set for every combination of rows and dims.
+    :return: a list of dicts, one per data set, with its 'rows', 'dims', 'k', 'generate_seconds' and 'stages'
+    """
+    runs = []
+    for num_rows in rows:
+        for dimensions in dims:
+            path = os.path.join(data_dir, f'lifting_{num_rows}x{dimensions}.csv')
+            start = time.perf_counter()
+            columns = write_lifting_csv(path, num_rows, dimensions)
+            generate_seconds = time.perf_counter() - start
+
+            run_stages = [stage for stage in stages if stage != 'legacy_load' or num_rows <= LEGACY_LOAD_MAX_ROWS]
+            results = bench_pipeline(path, columns, k, iterations, stages=run_stages,
+                                     render_max_points=render_max_points)
+            os.remove(path)
+            shutil.rmtree(path + '.cache', ignore_errors=True)
+
+            runs.append({'rows': num_rows, 'dims': dimensions, 'k': k, 'generate_seconds': generate_seconds,
+                         'stages': results})
+            summary = ', '.join(f"{stage} {values['seconds']:.3f}s" for stage, values in results.items()
+                                if 'seconds' in values)
+            print(f"{num_rows} rows x {dimensions} dims: {summary}")
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cluster.py pipeline on synthetic data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='data set sizes to generate (e.g. 1000 up to 10000000)')
+    parser.add_argument('--dims', type=int, nargs='+', default=[3, 8], help='numbers of columns (e.g. 3 up to 50)')
+    parser.add_argument('--k', type=int, default=8, help='the number of clusters')
+    parser.add_argument('--iterations', type=int, default=100, help='the iteration cap for create_clusters')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES), help='the stages to time')
+    parser.add_argument('--render-max-points', type=int, default=100000, help='the points drawn when rendering')
+    parser.add_argument('--data-dir', default=None, help='where to write the generated .csv files (a temp dir)')
+    parser.add_argument('--output', default='bench_results.json', help='the JSON file to write the results to')
+    parser.add_argument('--compare-seeding', action='store_true',
+                        help='compare iterations to converge for each seeding method instead')
+    parser.add_argument('--compare-precision', action='store_true',
+                        help='compare float64 and float32 storage of the points instead')
+    parser.add_argument('--compare-coreset', action='store_true',
+                        help='compare the accuracy and speedup of coreset_clusters over an exact fit instead')
+    args = parser.parse_args()
+
+    if args.compare_coreset:
+        points = make_blobs(args.rows[-1], args.dims[-1], args.k)
+        print(f"{'method':<13}{'size':>8}{'seconds':>10}{'speedup':>10}{'inertia ratio':>15}{'within 5%':>11}")
+        for row in bench_coreset(points, args.k):
+            print(f"{row['method']:<13}{row['size']:>8}{row['seconds']:>10.3f}{row['speedup']:>10.1f}"
+                  f"{row['inertia_ratio']:>15.4f}{str(row['within_bound']):>11}")
+        return
+
+    if args.compare_precision:
+        for key, value in bench_precision(make_blobs(args.rows[-1], args.dims[-1], args.k), args.k).items():
+            print(f'{key:<20}{value:>16.6g}')
+        return
+
+    if args.compare_seeding:
+        points = make_blobs(20000, 5, 10)
+        print(f"{'method':<10}{'iterations':>12}{'seed (s)':>12}{'total (s)':>12}{'inertia':>16}")
+        for row in bench_seeding(points, 10, runs=5):
+            print(f"{row['method']:<10}{row['iterations']:>12.1f}{row['seed_time']:>12.4f}"
+                  f"{row['total_time']:>12.4f}{row['inertia']:>16.1f}")
+        return
+
+    with tempfile.TemporaryDirectory(dir=args.data_dir) as data_dir:
+        runs = run_suite(args.rows, args.dims, args.k, args.iterations, args.stages, data_dir, args.render_max_points)
+
+    with open(args.output, 'w') as fp:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                   'numpy': np.__version__, 'machine': platform.machine(), 'runs': runs}, fp, indent=2)
+    print(f"wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
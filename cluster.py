@@ -6,12 +6,203 @@ data sets of a generic size and content. In particular, to run cluster.py on a d
 containing the calories, macros, and quantitative performance data from a period of induced
 muscle growth to determine optimal caloric and macro intake for training purposes.
 """
+import argparse
+import atexit
+import contextlib
+import cProfile
+import functools
+import itertools
+import json
 import math
+import multiprocessing
+import os
 import random
-import turtle
+import tempfile
+import time
+from multiprocessing import shared_memory
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
+
+# the most points assigned per block by the NumPy backend, and the byte budget of the (rows, k, d) temporary array;
+# blocks are made smaller than ASSIGN_CHUNK_ROWS whenever k * d is large enough that they would exceed the budget
+ASSIGN_CHUNK_ROWS = 65536
+ASSIGN_BLOCK_BYTES = 1 << 26
+
+# the number of .csv lines parsed per chunk by load_points, and the block size used when counting the rows
+LOAD_CHUNK_ROWS = 65536
+LOAD_BLOCK_BYTES = 1 << 20
+
+# the relative slack the Hamerly backend leaves on its bounds so that rounding never lets it skip a point whose
+# assignment could change
+HAMERLY_MARGIN = 1e-9
+
+# color identifiers for the first clusters drawn by visualize_clusters; more clusters use a colormap
+CLUSTER_COLORS = ['red', 'blue', 'green', 'orange', 'yellow']
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of the stages of this module. While a Profiler is enabled (see enable_profiling and
+    profiling) every instrumented function adds its wall time to a named stage (parse, seed, assign, update, reseed,
+    render, ...) and bumps counters such as distance_evaluations, reassigned_points and bytes_allocated (the size of the
+    main arrays created). When profiling is off each instrumented call costs a single check of a module global.
+    """
+
+    def __init__(self, cprofile=False):
+        """
+        :param: cprofile : if True also run cProfile while enabled, for dump_stats
+        """
+        self.timings = {}
+        self.counters = {}
+        self._active = set()
+        self._cprofile = cProfile.Profile() if cprofile else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        A context manager that adds the time spent inside it to stage name. Nested uses of the same stage (e.g.
+        load_points reading through load_column_cache) are only counted once.
+        """
+        if name in self._active:
+            yield
+            return
+        self._active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timing = self.timings.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            timing['calls'] += 1
+            timing['seconds'] += time.perf_counter() - start
+            self._active.discard(name)
+
+    def count(self, name, value=1):
+        """
+        Adds value to the counter name.
+        """
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def report(self):
+        """
+        :return: a dict with the 'timings' of every stage (calls and seconds) and the 'counters'
+        """
+        return {'timings': {name: dict(timing) for name, timing in self.timings.items()},
+                'counters': dict(self.counters)}
+
+    def to_json(self, path):
+        """
+        Writes report() to a .json file.
+        """
+        with open(path, 'w') as fp:
+            json.dump(self.report(), fp, indent=2)
+
+    def dump_stats(self, path):
+        """
+        Writes the cProfile statistics (readable with pstats or snakeviz) to path; needs cprofile=True.
+        """
+        if self._cprofile is None:
+            raise ValueError("this Profiler was not created with cprofile=True")
+        self._cprofile.dump_stats(path)
+
+
+# the enabled Profiler, or None when profiling is off
+_profiler = None
+
+
+def enable_profiling(cprofile=False):
+    """
+    Turns on instrumentation with a new Profiler.
+    :param: cprofile : if True also run cProfile until disable_profiling is called
+    :return: the Profiler, whose report() can be read at any time
+    """
+    global _profiler
+    disable_profiling()
+    _profiler = Profiler(cprofile)
+    if _profiler._cprofile is not None:
+        _profiler._cprofile.enable()
+    return _profiler
+
+
+def disable_profiling():
+    """
+    Turns off instrumentation.
+    :return: the Profiler that was enabled, or None
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None and profiler._cprofile is not None:
+        profiler._cprofile.disable()
+    return profiler
+
+
+@contextlib.contextmanager
+def profiling(cprofile=False):
+    """
+    A context manager that profiles the code inside it, e.g.
+
+        with profiling() as profiler:
+            create_clusters(k, centrds, points, 100)
+        print(profiler.report())
+    """
+    profiler = enable_profiling(cprofile)
+    try:
+        yield profiler
+    finally:
+        if _profiler is profiler:
+            disable_profiling()
+
+
+def _profiled(stage):
+    """
+    A decorator that times every call of a function as stage when profiling is on.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _stage(name):
+    """
+    The context manager timing stage name with the enabled Profiler, or a do-nothing one when profiling is off.
+    """
+    return _NO_STAGE if _profiler is None else _profiler.stage(name)
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+def _count(name, value):
+    """
+    Bumps a counter of the enabled Profiler, if there is one.
+    """
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+
+def _profile_from_environment(path):
+    """
+    Profiles the whole process when the CLUSTER_PROFILE environment variable names an output file, so that production
+    runs can be profiled without code changes: a .prof path gets cProfile statistics, anything else the JSON report.
+    """
+    cprofile = path.endswith('.prof')
+    profiler = enable_profiling(cprofile)
+
+    def write():
+        disable_profiling()
+        if cprofile:
+            profiler.dump_stats(path)
+        else:
+            profiler.to_json(path)
+    atexit.register(write)
+
+
+if os.environ.get('CLUSTER_PROFILE'):
+    _profile_from_environment(os.environ['CLUSTER_PROFILE'])
 
 
 def beautify_data(fp):
@@ -23,11 +214,16 @@ def beautify_data(fp):
     categories = []
     initial = True
     for line in fp:
+        # skip blank lines, such as a trailing one at the end of the file
+        if not line.strip():
+            continue
+
         # split on all commas
         current = line.strip().split(',')
 
         # if it is the first line initialize
         if initial:
+            categories = current
             data = {cat:[] for cat in current}
             initial = False
 
@@ -67,6 +263,247 @@ def build_point_list(data_dict):
     return points
 
 
+def count_data_rows(path, block_bytes=LOAD_BLOCK_BYTES):
+    """
+    Counts the lines after the header of a .csv file by reading it in fixed size binary blocks, so that the count never
+    needs more than one block in memory. Blank lines are counted too, so this is an upper bound on the data rows.
+    :param: path : the path to the .csv file
+    :param: block_bytes : the number of bytes read at a time
+    :return: the number of lines after the header as an int
+    """
+    lines = 0
+    last = b'\n'
+    with open(path, 'rb') as fp:
+        while True:
+            block = fp.read(block_bytes)
+            if not block:
+                break
+            lines += block.count(b'\n')
+            last = block[-1:]
+
+    # count a final line with no newline, but not the header
+    if last != b'\n':
+        lines += 1
+    return max(lines - 1, 0)
+
+
+def csv_columns(path, columns=None):
+    """
+    Reads the header of a .csv file and finds where the requested columns are. Columns with an empty header (such as the
+    one left by the trailing comma in bulkData.csv) are skipped.
+    :param: path : the path to the .csv file
+    :param: columns : a list of header names, or None for every named column
+    :return: columns, usecols : the list of column names and the list of their positions in each line
+    """
+    with open(path, 'r', newline='') as fp:
+        header = fp.readline().strip().split(',')
+    if columns is None:
+        columns = [cat for cat in header if cat != '']
+    missing = [cat for cat in columns if cat not in header]
+    if missing:
+        raise ValueError(f"columns {missing} are not in the header of {path}")
+
+    return list(columns), [header.index(cat) for cat in columns]
+
+
+def iter_point_chunks(path, columns=None, dtype=np.float64, chunk_rows=LOAD_CHUNK_ROWS):
+    """
+    A generator that streams the data points of a .csv file as (rows, d) arrays of at most chunk_rows points each, so
+    that only one chunk of the file is in memory at a time.
+    :param: path : the path to the .csv file
+    :param: columns : a list of header names to load, or None for every named column (see csv_columns)
+    :param: dtype : the float type of the yielded arrays
+    :param: chunk_rows : the number of lines parsed at a time
+    :return: yields (rows, d) arrays of points in file order
+    """
+    _, usecols = csv_columns(path, columns)
+
+    with open(path, 'r', newline='') as fp:
+        # skip the header
+        fp.readline()
+        while True:
+            lines = [line for line in itertools.islice(fp, chunk_rows) if line.strip()]
+            if not lines:
+                break
+            yield np.loadtxt(lines, delimiter=',', usecols=usecols, dtype=dtype, ndmin=2)
+
+
+@_profiled('parse')
+def load_points(path, columns=None, dtype=np.float64, chunk_rows=LOAD_CHUNK_ROWS, cache=False):
+    """
+    Loads the data points from a .csv file straight into a preallocated (n, d) NumPy array without building the
+    intermediate dictionary of strings and list of lists made by beautify_data and build_point_list. The file is
+    streamed chunk_rows lines at a time, so apart from the output array the memory used stays bounded however large the
+    file is. Columns with an empty header (such as the one left by the trailing comma in bulkData.csv) are skipped.
+    :param: path : the path to the .csv file
+    :param: columns : a list of header names to load, in the order they should appear in each point (e.g.
+                      ["Calories", "PRO (g)", "Work Fraction"]); all named columns are loaded when None
+    :param: dtype : the float type of the returned array, np.float64 or np.float32
+    :param: chunk_rows : the number of lines parsed at a time
+    :param: cache : if True read the columns from the binary columnar cache next to the file (see load_column_cache)
+                    instead of parsing the text, building the cache on the first call
+    :return: points, columns : the (n, d) array of points and the list of column names in the order they were loaded
+    """
+    if cache:
+        mapped = load_column_cache(path, columns)
+        points = np.empty((len(next(iter(mapped.values()))) if mapped else 0, len(mapped)), dtype=dtype)
+        _count('bytes_allocated', points.nbytes)
+        for i, column in enumerate(mapped.values()):
+            points[:, i] = column
+        return points, list(mapped)
+
+    columns, _ = csv_columns(path, columns)
+    points = np.empty((count_data_rows(path), len(columns)), dtype=dtype)
+    _count('bytes_allocated', points.nbytes)
+    filled = 0
+
+    for block in iter_point_chunks(path, columns, dtype, chunk_rows):
+        points[filled:filled + len(block)] = block
+        filled += len(block)
+
+    return points[:filled], columns
+
+
+def _cache_dir(path, cache_dir=None):
+    """
+    The directory that holds the columnar cache of a .csv file: cache_dir if one is given, or else next to the file
+    itself.
+    """
+    return os.fspath(path) + '.cache' if cache_dir is None else os.fspath(cache_dir)
+
+
+def _read_cache_meta(path, cache_dir=None):
+    """
+    Reads the metadata of the columnar cache of a .csv file.
+    :return: the metadata dict, or None if there is no cache or the .csv has changed size or mtime since it was built
+    """
+    try:
+        with open(os.path.join(_cache_dir(path, cache_dir), 'meta.json')) as fp:
+            meta = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    stat = os.stat(path)
+    if meta.get('source_size') != stat.st_size or meta.get('source_mtime_ns') != stat.st_mtime_ns:
+        return None
+    return meta
+
+
+@_profiled('parse')
+def build_column_cache(path, chunk_rows=LOAD_CHUNK_ROWS, cache_dir=None):
+    """
+    Parses a .csv file once and writes a binary columnar cache next to it: one float64 .npy file per named column plus
+    a meta.json holding the column names, the row count and the size and mtime of the .csv it was built from. The
+    columns are filled chunk by chunk through memory maps, so memory use stays bounded.
+    :param: path : the path to the .csv file
+    :param: chunk_rows : the number of lines parsed at a time
+    :param: cache_dir : the directory to write the cache to instead of next to the file, e.g. when the data directory
+                        is read-only
+    :return: the metadata dict
+    """
+    stat = os.stat(path)
+    columns, _ = csv_columns(path)
+    cache_dir = _cache_dir(path, cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    num_rows = count_data_rows(path)
+    files = [f'col_{i:04d}.npy' for i in range(len(columns))]
+    arrays = [np.lib.format.open_memmap(os.path.join(cache_dir, name), mode='w+', dtype=np.float64,
+                                        shape=(num_rows,)) for name in files]
+    filled = 0
+    for block in iter_point_chunks(path, columns, chunk_rows=chunk_rows):
+        for i, array in enumerate(arrays):
+            array[filled:filled + len(block)] = block[:, i]
+        filled += len(block)
+    for array in arrays:
+        array.flush()
+    del arrays
+
+    # the metadata is written last, so a cache that was cut short is never read
+    meta = {'columns': columns, 'files': files, 'rows': filled, 'source_size': stat.st_size,
+            'source_mtime_ns': stat.st_mtime_ns}
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp)
+    return meta
+
+
+@_profiled('parse')
+def load_column_cache(path, columns=None, cache_dir=None):
+    """
+    Memory-maps the requested columns of a .csv file from its columnar cache, building (or rebuilding, if the .csv has
+    changed size or mtime) the cache first when needed. Nothing is copied: each column is a read-only view of its
+    file, and columns that are not requested are never opened.
+    :param: path : the path to the .csv file
+    :param: columns : a list of header names, or None for every named column
+    :param: cache_dir : the directory the cache is kept in instead of next to the file (see build_column_cache)
+    :return: a dict mapping each column name to a 1D read-only float64 np.memmap
+    """
+    meta = _read_cache_meta(path, cache_dir) or build_column_cache(path, cache_dir=cache_dir)
+    columns = meta['columns'] if columns is None else list(columns)
+    missing = [cat for cat in columns if cat not in meta['columns']]
+    if missing:
+        raise ValueError(f"columns {missing} are not in the header of {path}")
+
+    cache_dir = _cache_dir(path, cache_dir)
+    return {cat: np.load(os.path.join(cache_dir, meta['files'][meta['columns'].index(cat)]),
+                         mmap_mode='r')[:meta['rows']] for cat in columns}
+
+
+SCALING_METHODS = ('zscore', 'minmax', 'robust')
+
+
+@_profiled('scale')
+def fit_scaler(points, method='zscore'):
+    """
+    Finds the per-feature offset and scale that put every feature in comparable units, so that large valued features
+    such as Calories do not swamp small ones such as Work Fraction in the distance. 'zscore' uses the mean and standard
+    deviation, 'minmax' the minimum and range, and 'robust' the median and interquartile range. Each statistic is one
+    vectorized pass over the columns. Constant features get a scale of 1.
+    :param: points : an (n, d) array of raw points
+    :param: method : one of SCALING_METHODS
+    :return: offset, scale : two float64 arrays of length d; the scaled points are (points - offset) / scale
+    """
+    if method not in SCALING_METHODS:
+        raise ValueError(f"unknown scaling method {method!r}, expected one of {SCALING_METHODS}")
+    points = np.asarray(points)
+
+    if method == 'zscore':
+        offset, scale = points.mean(axis=0, dtype=np.float64), points.std(axis=0, dtype=np.float64)
+    elif method == 'minmax':
+        offset = points.min(axis=0).astype(np.float64)
+        scale = points.max(axis=0) - offset
+    else:
+        q1, offset, q3 = np.percentile(points, [25, 50, 75], axis=0)
+        scale = q3 - q1
+
+    scale = np.where(scale > 0, scale, 1.0)
+    return offset, scale
+
+
+@_profiled('scale')
+def scale_points(points, offset, scale):
+    """
+    Scales points in place as (points - offset) / scale, without making a copy of the array.
+    :param: points : an (n, d) float array, modified in place
+    :param: offset, scale : from fit_scaler
+    :return: points
+    """
+    points -= offset.astype(points.dtype, copy=False)
+    points /= scale.astype(points.dtype, copy=False)
+    return points
+
+
+def unscale_points(points, offset, scale):
+    """
+    Maps scaled points (such as the centroids of a fit on scaled points) back to the original units, returning a new
+    array, e.g. to show the centroids with visualize_clusters or in reports.
+    :param: points : an (n, d) array of scaled points
+    :param: offset, scale : from fit_scaler
+    :return: an (n, d) float64 array of points in the original units
+    """
+    return np.asarray(points, dtype=np.float64) * scale + offset
+
+
 def centroids(points):
     """
     A function that takes a list of tuples (i.e. points) and then finds the mean for each dimension.
@@ -88,53 +525,337 @@ def centroids(points):
     return np.array(centroid)
 
 
-def pick_initial_centroids(k, points):
+def _sq_dists_to(points, centroid):
     """
-    A function which randomly picks the initial centroids for the clustering.
+    The squared Euclidean distance from every point in an (n, d) array to a single centroid, as an (n,) array.
+    """
+    diff = points - centroid
+    return np.einsum('ij,ij->i', diff, diff)
+
+
+def _d2_sample(points, k, rng, weights=None, min_sq=None):
+    """
+    k-means++ seeding. The first centroid is a (weighted) random point and each following centroid is drawn with
+    probability proportional to weight * D(x)^2, where D(x) is the distance from x to the nearest centroid picked so
+    far. The nearest distances are kept in one array that is updated with a single vectorized pass per centroid.
+    When min_sq (the squared distance from each point to the centroids there already are) is given, all k centroids
+    are drawn by D^2 sampling against those instead.
+    :return: the indexes of the k picked points
+    """
+    num_points = len(points)
+    weights = np.ones(num_points) if weights is None else np.asarray(weights, dtype=np.float64)
+    ids = []
+    if min_sq is None:
+        ids.append(int(rng.choice(num_points, p=weights / weights.sum())))
+        min_sq = _sq_dists_to(points, points[ids[0]])
+    else:
+        min_sq = np.array(min_sq, dtype=np.float64)
+
+    while len(ids) < k:
+        scores = weights * min_sq
+        total = scores.sum()
+        if total > 0:
+            index = int(np.searchsorted(np.cumsum(scores), rng.random() * total, side='right'))
+            index = min(index, num_points - 1)
+        else:
+            # every point sits on a centroid already; any point not yet picked will do
+            index = int(rng.choice(np.setdiff1d(np.arange(num_points), ids)))
+        ids.append(index)
+        np.minimum(min_sq, _sq_dists_to(points, points[index]), out=min_sq)
+
+    return ids
+
+
+def _kmeans_parallel_ids(points, k, rng, oversampling=None, rounds=5):
+    """
+    k-means|| seeding (Bahmani et al.). Starting from one random point, each round keeps every point independently with
+    probability oversampling * D(x)^2 / sum(D^2), so a few passes over the data collect O(k * rounds) candidates. The
+    candidates are weighted by how many points are closest to them and reduced to k centroids with weighted k-means++.
+    :return: the indexes of the k picked points
+    """
+    num_points = len(points)
+    oversampling = 2 * k if oversampling is None else oversampling
+    candidates = [int(rng.integers(num_points))]
+    min_sq = _sq_dists_to(points, points[candidates[0]])
+
+    for _ in range(rounds):
+        total = min_sq.sum()
+        if total == 0:
+            break
+        picked = np.flatnonzero(rng.random(num_points) < oversampling * min_sq / total)
+        if len(picked) == 0:
+            continue
+        candidates.extend(picked.tolist())
+        np.minimum(min_sq, assign_points(points, points[picked])[1], out=min_sq)
+
+    candidates = np.unique(candidates)
+    if len(candidates) < k:
+        # too few distinct candidates were drawn; top them up with random points not yet chosen
+        rest = np.setdiff1d(np.arange(num_points), candidates)
+        candidates = np.concatenate([candidates, rng.choice(rest, size=k - len(candidates), replace=False)])
+
+    weights = np.bincount(assign_points(points, points[candidates])[0], minlength=len(candidates))
+    # a candidate can end up with no points closest to it if it duplicates another; give it a little weight anyway
+    weights = np.maximum(weights, 1e-12)
+    return candidates[_d2_sample(points[candidates], k, rng, weights)].tolist()
+
+
+SEEDING_METHODS = ('random', 'kmeans++', 'kmeans||')
+
+
+@_profiled('seed')
+def pick_initial_centroids(k, points, method='random', seed=None):
+    """
+    A function which picks the initial centroids for the clustering. By default they are picked randomly; 'kmeans++'
+    picks them strategically by spreading them out over the data, which usually needs fewer iterations (and fewer
+    restarts) to converge, and 'kmeans||' does the same with a few oversampling passes that scale better to large data.
     :param: k : the number of centroids to be picked initially
-    :param: points : a list of points represented as tuples
+    :param: points : a list of points represented as tuples, or an (n, d) array
+    :param: method : one of SEEDING_METHODS
+    :param: seed : an int seed or a np.random.Generator for reproducible picks. With method='random' and no seed the
+                   global random module is used, as before.
     :return: a list of centroids which are points represented as tuples
     """
+    if method not in SEEDING_METHODS:
+        raise ValueError(f"unknown seeding method {method!r}, expected one of {SEEDING_METHODS}")
+    num_points = len(points)
+    if k > num_points:
+        raise ValueError(f"cannot pick {k} centroids from {num_points} points")
+
+    if method != 'random' or seed is not None:
+        rng = np.random.default_rng(seed)
+        points = as_point_array(points)
+        if method == 'kmeans++':
+            ids = _d2_sample(points, k, rng)
+        elif method == 'kmeans||':
+            ids = _kmeans_parallel_ids(points, k, rng)
+        else:
+            ids = rng.choice(num_points, size=k, replace=False)
+        return points[ids].copy()
+
     centroid_count = 0
-    centroid_ids = []
+    centroid_ids = set()
     centroid_list = []
-    num_points = len(points)
 
     while centroid_count < k:
-        # here we pick centroids randomly, maybe choose them strategically?
         index = random.randint(0, num_points - 1)
 
         if index not in centroid_ids:
             centroid_list.append(points[index])
-            centroid_ids.append(index)
+            centroid_ids.add(index)
             centroid_count += 1
 
     return np.array(centroid_list)
 
 
+def as_point_array(data_points, dtype=None):
+    """
+    Converts a list of points (tuples or lists) into a single contiguous (n, d) NumPy array. Arrays that are already
+    contiguous float64 or float32 are passed through without copying, so a float32 array (e.g. from
+    load_points(..., dtype=np.float32)) stays in the compact precision all the way through the pipeline. The distance
+    kernels and centroid sums upcast each block to float64, so only the storage of the points is compact.
+    :param: data_points : a list of n-dimensional points, or an existing (n, d) array
+    :param: dtype : np.float64 or np.float32; by default float32 arrays stay float32 and everything else is float64
+    :return: an (n, d) C-contiguous float array of the points
+    """
+    if dtype is None:
+        dtype = np.float32 if getattr(data_points, 'dtype', None) == np.float32 else np.float64
+    points = np.ascontiguousarray(data_points, dtype=dtype)
+    if points is not data_points:
+        _count('bytes_allocated', points.nbytes)
+    return points
+
 
-def create_clusters(k, centrds, data_points, iterations):
+def labels_to_clusters(labels, k):
     """
-    A function that creates the actual clusters for the data. It does this by calculating the distance between each point
-    and each of the initial centroids (each of which correspond to a cluster), and then assigns each point to the cluster
-    which it is closest to. The distance is calculated using a Euclidean distance function which calculates distance in
-    n-dimensions (where n is the total dimensions of each point). After each iteration a new centroid for each cluster is calculated
-    which will serve as the next iteration's initial centroid.
-    :param: k : the number of clusters to be produced
-    :param: centrds : the initial centroids for the clustering
-    :param: data_points : a list of tuples which each represent a different data point
-    :param: iterations : the number of iterations that the clustering will run before all the points are considered "settled"
-    :return: clusters : a list of integers representing the indexes of the points in data_points that are in each cluster
+    Turns a label vector (one cluster id per point) into the list of index lists used throughout this module.
+    :param: labels : a 1D integer array where labels[i] is the cluster that point i belongs to
+    :param: k : the number of clusters
+    :return: a list of k lists, each holding the (ascending) indexes of the points in that cluster
+    """
+    order = np.argsort(labels, kind='stable')
+    bounds = np.cumsum(np.bincount(labels, minlength=k))[:-1]
+    return [ids.tolist() for ids in np.split(order, bounds)]
+
+
+def _block_rows(centrds, chunk_rows):
+    """
+    The number of points to handle per block when comparing them with all of centrds, so that the (rows, k, d) float64
+    temporary stays within ASSIGN_BLOCK_BYTES (and the block within chunk_rows) however many centroids and dimensions
+    there are.
+    """
+    return max(1, min(chunk_rows, ASSIGN_BLOCK_BYTES // (8 * max(1, centrds.size))))
+
+
+@_profiled('assign')
+def assign_points(points, centrds, chunk_rows=ASSIGN_CHUNK_ROWS, distance=None):
+    """
+    Assigns every point to its nearest centroid in one batched computation. The squared distances between a block of
+    points and all of the centroids are found by broadcasting, and the nearest centroid is found with argmin. Points are
+    processed in blocks of at most chunk_rows, made smaller for large k and d (see _block_rows), so that the temporary
+    (rows, k, d) array stays bounded for very large data sets.
+    :param: points : an (n, d) float array of data points
+    :param: centrds : a (k, d) float array of centroids
+    :param: chunk_rows : the most points handled per block
+    :param: distance : a kernel from make_distance to use instead of the squared Euclidean distance
+    :return: labels, sq_dists : the index of the closest centroid for each point and the squared distance to it (or
+             the kernel's distance, if one is given)
+    """
+    num_points = len(points)
+    labels = np.empty(num_points, dtype=np.intp)
+    sq_dists = np.empty(num_points, dtype=np.float64)
+    chunk_rows = _block_rows(np.asarray(centrds), chunk_rows)
+
+    for start in range(0, num_points, chunk_rows):
+        block = points[start:start + chunk_rows]
+        if distance is not None:
+            block_sq = distance(block, centrds)
+        else:
+            diff = block[:, np.newaxis, :] - centrds[np.newaxis, :, :]
+            block_sq = np.einsum('ijk,ijk->ij', diff, diff)
+        block_labels = block_sq.argmin(axis=1)
+        labels[start:start + chunk_rows] = block_labels
+        sq_dists[start:start + chunk_rows] = block_sq[np.arange(len(block)), block_labels]
+
+    _count('distance_evaluations', num_points * len(centrds))
+    _count('bytes_allocated', labels.nbytes + sq_dists.nbytes)
+    return labels, sq_dists
+
+
+DISTANCE_METRICS = ('euclidean', 'weighted', 'mahalanobis', 'cosine')
+
+
+def make_distance(metric, weights=None, inv_cov=None, cholesky=None):
+    """
+    Builds a batched distance kernel for assign_points and create_clusters. A kernel takes a (rows, d) block of points
+    and the (k, d) centroids and returns the (rows, k) matrix of distances between them in one vectorized computation,
+    transforming only the block it is given, so the data never has to be rescaled or whitened by hand (which would
+    make a full copy of it).
+    'euclidean' and 'weighted' give the squared (weighted) Euclidean distance sum_j w_j (x_j - c_j)^2. 'mahalanobis'
+    gives the squared Mahalanobis distance (x - c)^T S^-1 (x - c), from either the inverse covariance S^-1 or the lower
+    Cholesky factor L of the covariance S = L L^T; either way the factor is inverted once, here, and each block is
+    whitened with one matrix product. 'cosine' gives 1 - cos(angle between x and c), with 1 for a zero vector.
+    :param: metric : one of DISTANCE_METRICS
+    :param: weights : the per-feature weights for 'weighted'
+    :param: inv_cov : the (d, d) inverse covariance for 'mahalanobis'
+    :param: cholesky : the (d, d) lower Cholesky factor of the covariance for 'mahalanobis', used if inv_cov is None
+    :return: the kernel function
+    """
+    if metric not in DISTANCE_METRICS:
+        raise ValueError(f"unknown distance metric {metric!r}, expected one of {DISTANCE_METRICS}")
+
+    if metric == 'cosine':
+        return _cosine_kernel
+
+    if metric == 'mahalanobis':
+        if inv_cov is not None:
+            # S^-1 = M M^T, so (x - c)^T S^-1 (x - c) = |(x - c) M|^2
+            whiten = np.linalg.cholesky(np.asarray(inv_cov, dtype=np.float64))
+        elif cholesky is not None:
+            # S = L L^T, so (x - c)^T S^-1 (x - c) = |L^-1 (x - c)|^2 = |(x - c) L^-T|^2
+            whiten = np.linalg.inv(np.asarray(cholesky, dtype=np.float64)).T
+        else:
+            raise ValueError("the mahalanobis distance needs inv_cov or cholesky")
+        return functools.partial(_whitened_kernel, whiten=whiten)
+
+    if weights is None or metric == 'euclidean':
+        weights = np.ones(1)
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.ndim != 1 or not len(weights) or not np.all(np.isfinite(weights)) or np.any(weights < 0):
+            raise ValueError("the weights must be a 1D sequence of finite, non-negative numbers, one per feature")
+    return functools.partial(_weighted_kernel, weights=weights)
+
+
+# the kernels made by make_distance; they are module level functions bound with functools.partial so that they can be
+# pickled and sent to pool workers (see sharded_clusters)
+def _cosine_kernel(block, centrds):
+    block_norms = np.sqrt(np.einsum('ij,ij->i', block, block, dtype=np.float64))
+    centrd_norms = np.sqrt(np.einsum('ij,ij->i', centrds, centrds))
+    norms = np.outer(block_norms, centrd_norms)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosines = np.where(norms > 0, (block @ centrds.T) / norms, 0.0)
+    return 1.0 - cosines
+
+
+def _whitened_kernel(block, centrds, whiten):
+    diff = (block @ whiten)[:, np.newaxis, :] - (centrds @ whiten)[np.newaxis, :, :]
+    return np.einsum('ijk,ijk->ij', diff, diff)
+
+
+def _weighted_kernel(block, centrds, weights):
+    if len(weights) not in (1, block.shape[1]):
+        raise ValueError(f"got {len(weights)} feature weights for points with {block.shape[1]} features")
+    diff = block[:, np.newaxis, :] - centrds[np.newaxis, :, :]
+    return np.einsum('ijk,ijk,k->ij', diff, diff, np.broadcast_to(weights, (block.shape[1],)))
+
+
+@_profiled('assign')
+def _nearest_two(points, centrds, chunk_rows=ASSIGN_CHUNK_ROWS):
+    """
+    Like assign_points, but also returns the squared distance from each point to its second closest centroid (inf when
+    there is only one centroid). Used to initialise the bounds of the Hamerly backend.
+    :return: labels, sq_nearest, sq_second
+    """
+    num_points = len(points)
+    labels = np.empty(num_points, dtype=np.intp)
+    sq_nearest = np.empty(num_points, dtype=np.float64)
+    sq_second = np.full(num_points, np.inf)
+    chunk_rows = _block_rows(centrds, chunk_rows)
+
+    for start in range(0, num_points, chunk_rows):
+        block = points[start:start + chunk_rows]
+        diff = block[:, np.newaxis, :] - centrds[np.newaxis, :, :]
+        block_sq = np.einsum('ijk,ijk->ij', diff, diff)
+        rows = np.arange(len(block))
+        block_labels = block_sq.argmin(axis=1)
+        labels[start:start + chunk_rows] = block_labels
+        sq_nearest[start:start + chunk_rows] = block_sq[rows, block_labels]
+        if block_sq.shape[1] > 1:
+            block_sq[rows, block_labels] = np.inf
+            sq_second[start:start + chunk_rows] = block_sq.min(axis=1)
+
+    _count('distance_evaluations', num_points * len(centrds))
+    _count('bytes_allocated', labels.nbytes + sq_nearest.nbytes + sq_second.nbytes)
+    return labels, sq_nearest, sq_second
+
+
+@_profiled('update')
+def update_centroids(points, labels, k):
+    """
+    Recomputes the centroid of every cluster from a label vector using unbuffered np.add.at sums and a bincount of the
+    cluster sizes. A cluster that received no points gets a centroid of all zeros, as in the loop implementation.
+    :param: points : an (n, d) float array of data points
+    :param: labels : a 1D integer array holding the cluster id of each point
+    :param: k : the number of clusters
+    :return: a (k, d) float64 array of the new centroids
+    """
+    sums = np.zeros((k, points.shape[1]), dtype=np.float64)
+    np.add.at(sums, labels, points)
+    counts = np.bincount(labels, minlength=k)
+    nonempty = counts > 0
+    sums[nonempty] /= counts[nonempty, np.newaxis]
+    return sums
+
+
+def _loop_step(k, centrds, data_points, state):
+    """
+    One iteration of the original pure Python implementation. It is kept as the reference that the NumPy backend is
+    checked against.
+    :param: k : the number of clusters
+    :param: centrds : a (k, d) array of the current centroids
+    :param: data_points : the data points as given to create_clusters
+    :param: state : a dict the backend may use to carry values between iterations (unused here)
+    :return: labels, inertia, new_centrds : the cluster id of each point, the sum of squared distances from each point
+             to its centroid, and the recomputed centroids
     """
     num_points = len(data_points)
     dimensions = len(data_points[0])
-    clusters = None
-
-    for i in range(iterations):
-        print("*****PASS: ", i, " *****")
-        
-        clusters = [[] for _ in range(k)]
+    clusters = [[] for _ in range(k)]
+    labels = np.empty(num_points, dtype=np.intp)
+    inertia = 0.0
 
+    with _stage('assign'):
         for points_id in range(num_points):
             # add the distance between ith data point and centroid, do this for each centroid
             distances = [nd_dist(data_points[points_id], centrds[clusterID]) for clusterID in range(k)]
@@ -145,7 +866,12 @@ def create_clusters(k, centrds, data_points, iterations):
 
             # add that point to the appropriate cluster
             clusters[min_id].append(points_id)
+            labels[points_id] = min_id
+            inertia += min_dist * min_dist
+    _count('distance_evaluations', num_points * k)
 
+    with _stage('update'):
+        new_centrds = np.array(centrds, dtype=np.float64)
         for clusterID in range(k):
             sums = [0]*dimensions
 
@@ -165,20 +891,1074 @@ def create_clusters(k, centrds, data_points, iterations):
                     sums[ind] /= cluster_len
 
             # add new centroids
-            centrds[clusterID] = sums
+            new_centrds[clusterID] = sums
+
+    return labels, inertia, new_centrds
+
+
+def _numpy_step(k, centrds, points, state):
+    """
+    One iteration of the vectorized implementation: a single broadcasted squared-distance computation plus argmin for
+    the assignment, then a grouped sum for the centroid update. Takes and returns the same values as _loop_step, but
+    expects points as an (n, d) float array.
+    """
+    labels, sq_dists = assign_points(points, centrds, distance=state.get('distance'))
+    return labels, float(sq_dists.sum()), update_centroids(points, labels, k)
+
+
+def _hamerly_step(k, centrds, points, state):
+    """
+    One iteration using Hamerly's triangle inequality bounds. For every point state keeps an upper bound on the distance
+    to its own centroid and a lower bound on the distance to every other centroid. When the upper bound is below both the
+    lower bound and half the distance from its centroid to the nearest other centroid the point cannot change cluster,
+    so its distances are not computed. The remaining points are assigned with the same kernel as _numpy_step, and a
+    small relative margin makes near ties always recompute, so the assignments match the 'numpy' and 'loop' backends
+    exactly. Adds 'distances' (point to centroid distances computed) and 'skipped' (distances proven unnecessary) to the
+    iteration record through state['stats'].
+    """
+    num_points = len(points)
+    with _stage('assign'):
+        if 'labels' not in state:
+            labels, sq_nearest, sq_second = _nearest_two(points, centrds)
+            upper, lower = np.sqrt(sq_nearest), np.sqrt(sq_second)
+            computed = num_points * k
+            state['sq_total'] = float(np.einsum('ij,ij->', points, points, dtype=np.float64))
+        else:
+            labels, upper, lower = state['labels'], state['upper'], state['lower']
+
+            # move the bounds by how far the centroids moved since they were last computed
+            drift = np.sqrt(((centrds - state['centrds']) ** 2).sum(axis=1))
+            upper += drift[labels]
+            lower -= drift.max()
+
+            # half the distance from each centroid to its nearest neighbouring centroid
+            diff = centrds[:, np.newaxis, :] - centrds[np.newaxis, :, :]
+            center_dists = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+            np.fill_diagonal(center_dists, np.inf)
+            half_gap = 0.5 * center_dists.min(axis=1)
+
+            bound = np.maximum(half_gap[labels], lower) * (1 - HAMERLY_MARGIN)
+            check = np.flatnonzero(upper >= bound)
+
+            # tighten the upper bound of the points that might move, then fully reassign the ones that still might
+            diff = points[check] - centrds[labels[check]]
+            upper[check] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+            _count('distance_evaluations', len(check))
+            recheck = check[upper[check] >= bound[check]]
+
+            new_labels, sq_nearest, sq_second = _nearest_two(points[recheck], centrds)
+            labels[recheck] = new_labels
+            upper[recheck] = np.sqrt(sq_nearest)
+            lower[recheck] = np.sqrt(sq_second)
+            computed = len(check) + len(recheck) * k
+
+    state['labels'], state['upper'], state['lower'] = labels, upper, lower
+    state['centrds'] = centrds.copy()
+    state['stats'] = {'distances': computed, 'skipped': num_points * k - computed}
+
+    with _stage('update'):
+        sums = np.zeros_like(centrds)
+        np.add.at(sums, labels, points)
+        counts = np.bincount(labels, minlength=k)
+
+        # sum |x - c|^2 = sum |x|^2 - sum_j (2 c_j . S_j - n_j |c_j|^2), so the inertia needs no per-point distances
+        inertia = state['sq_total'] - float((2 * np.einsum('ij,ij->i', centrds, sums)
+                                             - counts * np.einsum('ij,ij->i', centrds, centrds)).sum())
+
+    nonempty = counts > 0
+    sums[nonempty] /= counts[nonempty, np.newaxis]
+    return labels.copy(), max(inertia, 0.0), sums
+
+
+EMPTY_STRATEGIES = ('farthest', 'split', 'keep')
+
+
+@_profiled('reseed')
+def _reseed_empty(points, labels, centrds, counts, strategy):
+    """
+    Gives every empty cluster a new centroid, in one vectorized pass over the points to find the squared distance from
+    each point to its own centroid. 'farthest' moves each empty centroid onto one of the points farthest from their
+    centroids. 'split' splits the cluster with the highest inertia: its centroid c and the empty one are placed at
+    c - h and c + h, where h is half the offset from c to its farthest point. The points themselves keep their labels;
+    the next assignment pass moves them.
+    :param: points : the data points
+    :param: labels : the cluster id of each point
+    :param: centrds : a (k, d) array of the new centroids, modified in place
+    :param: counts : the number of points in each cluster
+    :param: strategy : 'farthest' or 'split'
+    :return: centrds, reseeded : the centroids and the list of the ids of the clusters that were empty
+    """
+    points = as_point_array(points)
+    diff = points - centrds[labels]
+    sq_dists = np.einsum('ij,ij->i', diff, diff)
+    empties = np.flatnonzero(counts == 0)
+
+    if strategy == 'farthest':
+        # only the few farthest points are needed, so partition rather than sort all of them
+        num_farthest = min(len(empties), len(points))
+        farthest = np.argpartition(sq_dists, len(points) - num_farthest)[len(points) - num_farthest:]
+        farthest = farthest[np.argsort(sq_dists[farthest])[::-1]]
+        centrds[empties[:num_farthest]] = points[farthest]
+    else:
+        k = len(centrds)
+        cluster_inertia = np.bincount(labels, weights=sq_dists, minlength=k)
+
+        # the farthest point of every cluster, found once: the largest distance per cluster, then a point that has it
+        cluster_max = np.full(k, -1.0)
+        np.maximum.at(cluster_max, labels, sq_dists)
+        at_max = np.flatnonzero(sq_dists == cluster_max[labels])
+        farthest_of = np.zeros(k, dtype=np.intp)
+        farthest_of[labels[at_max]] = at_max
+
+        for c_id in empties:
+            worst = int(cluster_inertia.argmax())
+            half = (points[farthest_of[worst]] - centrds[worst]) / 2
+            centrds[c_id] = centrds[worst] + half
+            centrds[worst] -= half
+            # split each cluster once per pass
+            cluster_inertia[worst] = -1.0
+
+    return centrds, empties.tolist()
+
+
+# each backend is (step function, whether the step wants the points as an (n, d) array)
+CLUSTER_BACKENDS = {
+    'loop': (_loop_step, False),
+    'numpy': (_numpy_step, True),
+    'hamerly': (_hamerly_step, True),
+}
+
 
+def create_clusters(k, centrds, data_points, iterations, backend='numpy', tol=0.0, moved_tol=0, callback=None,
+                    return_history=False, dtype=None, empty='farthest', distance=None):
+    """
+    A function that creates the actual clusters for the data. It does this by calculating the distance between each point
+    and each of the initial centroids (each of which correspond to a cluster), and then assigns each point to the cluster
+    which it is closest to. The distance is calculated using a Euclidean distance function which calculates distance in
+    n-dimensions (where n is the total dimensions of each point). After each iteration a new centroid for each cluster is calculated
+    which will serve as the next iteration's initial centroid. The clustering stops early once it has converged, that is
+    once no centroid moves more than tol or no more than moved_tol points changed cluster. With the defaults it only stops
+    when another iteration could not change the result.
+    :param: k : the number of clusters to be produced
+    :param: centrds : the initial centroids for the clustering
+    :param: data_points : a list of tuples which each represent a different data point
+    :param: iterations : the maximum number of iterations that the clustering will run before all the points are
+                         considered "settled"
+    :param: backend : the name of the engine in CLUSTER_BACKENDS to use; 'numpy' (the default) runs the batched array
+                      engine, 'hamerly' runs the same engine but uses triangle inequality bounds to skip distances
+                      that cannot change an assignment (fastest when k is large), and 'loop' runs the original pure
+                      Python loop. All of them give the same assignments. A step function with the same
+                      signature as _numpy_step may be passed instead of a name.
+    :param: tol : stop once the largest distance any centroid moved in an iteration is at most tol
+    :param: moved_tol : stop once at most this many points changed cluster in an iteration
+    :param: callback : an optional function called with the record (see below) of each iteration as it finishes
+    :param: return_history : if True also return the list of per-iteration records
+    :param: dtype : the precision the points are stored in (see as_point_array); pass np.float32 to halve the memory
+                    used by a list of points. The centroids are always float64.
+    :param: empty : what to do with the centroid of a cluster that gets no points, one of EMPTY_STRATEGIES (see
+                    _reseed_empty); 'keep' leaves it at the origin as the original implementation did
+    :param: distance : a kernel from make_distance (weighted, Mahalanobis or cosine distance) to assign the points
+                       with instead of the Euclidean distance. It is given to step functions as state['distance'];
+                       the 'numpy' backend and the steps of sharded_clusters and coreset_clusters use it, and the
+                       'loop' and 'hamerly' backends raise a ValueError. The centroids are still the means of their
+                       points.
+    :return: centrds, clusters : the final centroids, and a list of lists of integers representing the indexes of the
+                                 points in data_points that are in each cluster. If return_history is True a third value,
+                                 the list of records, is returned. Each record is a dict with the keys 'iteration',
+                                 'inertia' (sum of squared distances to the assigned centroids), 'moved' (points that
+                                 changed cluster), 'shift' (largest centroid movement), 'reseeded' (the ids of the
+                                 empty clusters whose centroids were reseeded) and 'time' (wall seconds);
+                                 some backends add their own keys, such as 'skipped' for 'hamerly'.
+    """
+    if empty not in EMPTY_STRATEGIES:
+        raise ValueError(f"unknown empty cluster strategy {empty!r}, expected one of {EMPTY_STRATEGIES}")
+    if callable(backend):
+        step, wants_array = backend, True
+    elif backend in CLUSTER_BACKENDS:
+        step, wants_array = CLUSTER_BACKENDS[backend]
+    else:
+        raise ValueError(f"unknown backend {backend!r}, expected one of {sorted(CLUSTER_BACKENDS)}")
+
+    if distance is not None and backend in ('loop', 'hamerly'):
+        raise ValueError(f"the {backend!r} backend only supports the Euclidean distance")
+
+    points = as_point_array(data_points, dtype) if wants_array else data_points
+    centrds = np.array(centrds, dtype=np.float64)
+    labels = None
+    history = []
+    state = {} if distance is None else {'distance': distance}
+
+    for i in range(iterations):
+        start = time.perf_counter()
+        new_labels, inertia, new_centrds = step(k, centrds, points, state)
+
+        reseeded = []
+        counts = np.bincount(new_labels, minlength=k)
+        if empty != 'keep' and not counts.all():
+            new_centrds, reseeded = _reseed_empty(points, new_labels, new_centrds, counts, empty)
+
+        moved = len(new_labels) if labels is None else int(np.count_nonzero(new_labels != labels))
+        if labels is not None:
+            _count('reassigned_points', moved)
+        shift = float(np.sqrt(((new_centrds - centrds) ** 2).sum(axis=1)).max())
+        labels, centrds = new_labels, new_centrds
+
+        record = {'iteration': i, 'inertia': inertia, 'moved': moved, 'shift': shift, 'reseeded': reseeded,
+                  'time': time.perf_counter() - start}
+        record.update(state.get('stats', {}))
+        history.append(record)
+        if callback is not None:
+            callback(record)
+
+        # a reseeded centroid has not had its points assigned yet, so the fit cannot have converged
+        if not reseeded and (shift <= tol or (i > 0 and moved <= moved_tol)):
+            break
+
+    if history and history[-1]['reseeded']:
+        # the iterations ran out right after a reseed, so assign the points to the centroids being returned
+        labels, _ = assign_points(as_point_array(points), centrds, distance=distance)
+
+    clusters = labels_to_clusters(labels, k) if labels is not None else None
+    if return_history:
+        return centrds, clusters, history
     return centrds, clusters
 
-def visualize_clusters(c, clusters, data_points, categories, sphere=False):
+
+def _iter_source_chunks(source, columns=None, chunk_rows=LOAD_CHUNK_ROWS):
+    """
+    Streams a point source in file order, chunk_rows points at a time. A source is either a path to a .csv file or an
+    (n, d) array, which may be a np.memmap (or np.load(..., mmap_mode='r')) so that it never has to fit in memory.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        yield from iter_point_chunks(source, columns, chunk_rows=chunk_rows)
+    else:
+        for start in range(0, len(source), chunk_rows):
+            yield np.asarray(source[start:start + chunk_rows], dtype=np.float64)
+
+
+class _ColumnPoints:
+    """
+    The memory-mapped columns of a columnar cache (see load_column_cache) seen as an (n, d) point array: indexing it
+    with a slice or an index array reads just those rows of every column into a new (m, d) float64 array.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, rows):
+        return np.column_stack([column[rows] for column in self.columns])
+
+
+def _iter_minibatches(source, batch_size, rng):
+    """
+    An endless generator of random batches of batch_size points from an (n, d) array source, such as a np.memmap or
+    _ColumnPoints, sampled uniformly with replacement from the whole source and reading the sampled rows in ascending
+    order so that memory-mapped files are read front to back.
+    """
+    while True:
+        ids = np.sort(rng.integers(0, len(source), size=batch_size))
+        yield np.asarray(source[ids], dtype=np.float64)
+
+
+def minibatch_clusters(k, centrds, source, iterations, batch_size=1024, columns=None, tol=0.0, seed=None,
+                       final_assign=True, callback=None, cache_dir=None):
+    """
+    A mini-batch version of create_clusters for data sets that are larger than memory. Each iteration draws a random
+    batch of points from the source, assigns them to their nearest centroid, and moves every centroid toward the mean of
+    its batch points with a per-cluster learning rate of (batch points)/(all points the centroid has seen so far). Memory
+    use depends on the batch size and not on the size of the data. Optionally a final pass streams the whole source once
+    to produce the same cluster index lists as create_clusters.
+    :param: k : the number of clusters to be produced
+    :param: centrds : the initial centroids, e.g. from pick_initial_centroids
+    :param: source : a path to a .csv file, or an (n, d) array such as a np.memmap. A .csv file is parsed once into a
+                     columnar cache (see load_column_cache) so that batches can be drawn from anywhere in it, even when
+                     it is ordered by time, and the final pass reads the cache rather than the text
+    :param: iterations : the maximum number of batches to use
+    :param: batch_size : the number of points in each batch
+    :param: columns : the .csv header names to cluster on when source is a path (see load_points)
+    :param: tol : stop once no centroid moves more than tol in a batch
+    :param: seed : the seed for the random batches, for reproducible runs
+    :param: final_assign : if True assign every point in the source to the final centroids
+    :param: callback : an optional function called with a record dict for each batch, with the keys 'iteration',
+                       'inertia' (of the batch), 'shift' and 'time' as in create_clusters
+    :param: cache_dir : where to keep the columnar cache of a .csv source so that later runs can reuse it; by default
+                        it is built in a temporary directory that is removed before returning, and nothing is written
+                        next to the .csv
+    :return: centrds, clusters : the final centroids and the list of lists of point indexes in each cluster (None if
+                                 final_assign is False)
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with contextlib.ExitStack() as stack:
+            if cache_dir is None:
+                cache_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            points = _ColumnPoints(load_column_cache(source, columns, cache_dir).values())
+            return minibatch_clusters(k, centrds, points, iterations, batch_size, tol=tol, seed=seed,
+                                      final_assign=final_assign, callback=callback)
+
+    rng = np.random.default_rng(seed)
+    centrds = np.array(centrds, dtype=np.float64)
+    counts = np.zeros(k, dtype=np.int64)
+    batches = _iter_minibatches(source, batch_size, rng)
+
+    for i in range(iterations):
+        start = time.perf_counter()
+        batch = next(batches)
+        labels, sq_dists = assign_points(batch, centrds)
+
+        batch_counts = np.bincount(labels, minlength=k)
+        batch_sums = np.zeros_like(centrds)
+        np.add.at(batch_sums, labels, batch)
+        counts += batch_counts
+
+        # c += (batch_sum - batch_count * c) / count is the running mean update with rate batch_count / count
+        hit = batch_counts > 0
+        step = (batch_sums[hit] - batch_counts[hit, np.newaxis] * centrds[hit]) / counts[hit, np.newaxis]
+        centrds[hit] += step
+        shift = float(np.sqrt((step ** 2).sum(axis=1)).max()) if hit.any() else 0.0
+
+        if callback is not None:
+            callback({'iteration': i, 'inertia': float(sq_dists.sum()), 'shift': shift,
+                      'time': time.perf_counter() - start})
+        if shift <= tol:
+            break
+
+    if not final_assign:
+        return centrds, None
+
+    labels = np.concatenate([assign_points(chunk, centrds)[0] for chunk in _iter_source_chunks(source, columns)])
+    return centrds, labels_to_clusters(labels, k)
+
+
+CORESET_METHODS = ('lightweight', 'sensitivity')
+
+
+def _stream_moments(source, columns=None, distance=None):
+    """
+    One streaming pass over a point source (see _iter_source_chunks) for its size, mean and total squared distance to
+    the mean, accumulated in float64. With a distance kernel (see make_distance) the total is of the kernel's distance
+    to the mean instead, which takes a second pass.
+    :return: num_points, mean, cost
+    """
+    num_points, sums, sq_total = 0, 0.0, 0.0
+    for chunk in _iter_source_chunks(source, columns):
+        num_points += len(chunk)
+        sums = sums + chunk.sum(axis=0, dtype=np.float64)
+        sq_total += float(np.einsum('ij,ij->', chunk, chunk, dtype=np.float64))
+    mean = sums / num_points
+    if distance is not None:
+        chunks = _iter_source_chunks(source, columns)
+        return num_points, mean, sum(float(distance(chunk, mean[np.newaxis, :]).sum()) for chunk in chunks)
+    return num_points, mean, max(sq_total - num_points * float(mean @ mean), 0.0)
+
+
+def _poisson_sample(source, columns, rng, inclusion):
+    """
+    One streaming pass that keeps every point independently with probability inclusion(chunk) (clipped to 1) and weights
+    each kept point by the inverse of that probability, so weighted sums over the sample are unbiased estimates of the
+    sums over the whole source.
+    :return: points, weights : the (m, d) float64 sample and its (m,) weights
+    """
+    kept, weights = [], []
+    for chunk in _iter_source_chunks(source, columns):
+        prob = np.minimum(inclusion(chunk), 1.0)
+        keep = rng.random(len(chunk)) < prob
+        kept.append(np.asarray(chunk[keep], dtype=np.float64))
+        weights.append(1.0 / prob[keep])
+    return np.concatenate(kept), np.concatenate(weights)
+
+
+def lightweight_coreset(source, size, seed=None, columns=None, distance=None):
+    """
+    A lightweight coreset (Bachem, Lucic and Krause 2018) of a point source, made in two streaming passes. Each point x
+    is sampled with probability proportional to q(x) = 1 / (2n) + d(x, mean)^2 / (2 * sum of d^2), so that points far
+    from the bulk of the data are more likely to be kept, and weighted by 1 / (its inclusion probability).
+    :param: source : a path to a .csv file or an (n, d) array such as a np.memmap
+    :param: size : the expected number of points in the coreset
+    :param: seed : an int seed or np.random.Generator
+    :param: columns : the .csv header names to use when source is a path
+    :param: distance : a kernel from make_distance to use in place of the squared Euclidean distance d^2
+    :return: points, weights : the coreset and the weight of each of its points
+    """
+    rng = np.random.default_rng(seed)
+    num_points, mean, cost = _stream_moments(source, columns, distance)
+
+    def inclusion(chunk):
+        if cost == 0:
+            return np.full(len(chunk), size / num_points)
+        if distance is None:
+            dists = _sq_dists_to(chunk, mean)
+        else:
+            dists = distance(chunk, mean[np.newaxis, :])[:, 0]
+        return size * (0.5 / num_points + 0.5 * dists / cost)
+
+    return _poisson_sample(source, columns, rng, inclusion)
+
+
+def sensitivity_coreset(source, k, size, seed=None, columns=None, distance=None):
+    """
+    A sensitivity sampling coreset of a point source. A rough solution B of k centroids is found first by k-means++ on
+    a lightweight coreset; then a pass over the data finds each point's distance to B and the sizes of B's clusters, and
+    a last pass samples each point x with probability proportional to its sensitivity bound
+    d(x, B)^2 / cost(B) + 1 / |cluster of x in B|, which keeps more of the points that could change the solution.
+    :param: source : a path to a .csv file or an (n, d) array such as a np.memmap
+    :param: k : the number of clusters
+    :param: size : the expected number of points in the coreset
+    :param: seed : an int seed or np.random.Generator
+    :param: columns : the .csv header names to use when source is a path
+    :param: distance : a kernel from make_distance to use in place of the squared Euclidean distance d^2
+    :return: points, weights : the coreset and the weight of each of its points
+    """
+    rng = np.random.default_rng(seed)
+    light, light_weights = lightweight_coreset(source, size, rng, columns, distance)
+    rough = light[_d2_sample(light, k, rng, light_weights)]
+
+    counts, cost = np.zeros(k, dtype=np.int64), 0.0
+    for chunk in _iter_source_chunks(source, columns):
+        labels, sq_dists = assign_points(chunk, rough, distance=distance)
+        counts += np.bincount(labels, minlength=k)
+        cost += float(sq_dists.sum())
+    # the bounds sum to 1 over the distance term and 1 per non-empty cluster
+    total = (1.0 if cost > 0 else 0.0) + np.count_nonzero(counts)
+
+    def inclusion(chunk):
+        labels, sq_dists = assign_points(chunk, rough, distance=distance)
+        sensitivity = (sq_dists / cost if cost > 0 else 0.0) + 1.0 / counts[labels]
+        return size * sensitivity / total
+
+    return _poisson_sample(source, columns, rng, inclusion)
+
+
+def _weighted_step(weights):
+    """
+    Makes a create_clusters step function for weighted points (such as a coreset): the assignment is the usual one, and
+    each centroid is the weighted mean of its points and the inertia the weighted sum of squared distances (or of the
+    distances of state['distance'], a kernel from make_distance, when there is one).
+    """
+    def step(k, centrds, points, state):
+        labels, sq_dists = assign_points(points, centrds, distance=state.get('distance'))
+        sums = np.zeros_like(centrds)
+        np.add.at(sums, labels, points * weights[:, np.newaxis])
+        totals = np.bincount(labels, weights=weights, minlength=k)
+        nonempty = totals > 0
+        sums[nonempty] /= totals[nonempty, np.newaxis]
+        return labels, float(sq_dists @ weights), sums
+    return step
+
+
+def coreset_clusters(k, source, coreset_size=10000, iterations=100, method='lightweight', seed=None, columns=None,
+                     final_assign=True, distance=None):
+    """
+    Approximate clustering for data sets too large to cluster exactly in reasonable time. A small weighted coreset is
+    drawn from the source in a few streaming passes (see lightweight_coreset and sensitivity_coreset), weighted k-means
+    (weighted k-means++ seeding then create_clusters with weighted centroid updates) is run on the coreset alone, and
+    then every point of the source is labelled in one vectorized streaming pass. Since the coreset's weighted inertia
+    estimates the inertia of the full data for any centroids, the report compares the two: their ratio shows how well
+    the coreset represents the data. Compare the 'inertia' with an exact create_clusters run to measure the accuracy.
+    :param: k : the number of clusters to be produced
+    :param: source : a path to a .csv file, or an (n, d) array such as a np.memmap
+    :param: coreset_size : the expected number of points in the coreset
+    :param: iterations : the maximum number of iterations on the coreset
+    :param: method : one of CORESET_METHODS
+    :param: seed : an int seed for reproducible runs
+    :param: columns : the .csv header names to cluster on when source is a path
+    :param: final_assign : if True label every point of the source with the final centroids
+    :param: distance : a kernel from make_distance used to sample the coreset, fit it and label the points, instead of
+                       the Euclidean distance; the inertias are then sums of the kernel's distances
+    :return: centrds, clusters, report : the centroids, the cluster index lists (None if final_assign is False), and a
+             dict with 'method', 'coreset_size', 'coreset_inertia' (the weighted estimate), 'inertia' (of the full data,
+             None if final_assign is False), 'iterations', and the 'coreset_seconds', 'fit_seconds' and 'label_seconds'
+    """
+    if method not in CORESET_METHODS:
+        raise ValueError(f"unknown coreset method {method!r}, expected one of {CORESET_METHODS}")
+    rng = np.random.default_rng(seed)
+
+    start = time.perf_counter()
+    if method == 'lightweight':
+        points, weights = lightweight_coreset(source, coreset_size, rng, columns, distance)
+    else:
+        points, weights = sensitivity_coreset(source, k, coreset_size, rng, columns, distance)
+    sampled = time.perf_counter()
+
+    initial = points[_d2_sample(points, k, rng, weights)]
+    centrds, _, history = create_clusters(k, initial, points, iterations, backend=_weighted_step(weights),
+                                          return_history=True, distance=distance)
+    fitted = time.perf_counter()
+
+    coreset_inertia = float(assign_points(points, centrds, distance=distance)[1] @ weights)
+    report = {'method': method, 'coreset_size': len(points), 'coreset_inertia': coreset_inertia, 'inertia': None,
+              'iterations': len(history), 'coreset_seconds': sampled - start, 'fit_seconds': fitted - sampled,
+              'label_seconds': 0.0}
+    if not final_assign:
+        return centrds, None, report
+
+    labels, inertia = [], 0.0
+    for chunk in _iter_source_chunks(source, columns):
+        chunk_labels, sq_dists = assign_points(chunk, centrds, distance=distance)
+        labels.append(chunk_labels)
+        inertia += float(sq_dists.sum())
+    report.update(inertia=inertia, label_seconds=time.perf_counter() - fitted)
+    return centrds, labels_to_clusters(np.concatenate(labels), k), report
+
+
+# the shared memory arrays a pool worker attached to in _attach_shared, by name
+_worker_arrays = {}
+
+
+@contextlib.contextmanager
+def _shared_array(array):
+    """
+    A context manager that copies an array into a new block of shared memory once, so that pool workers can map it
+    instead of each receiving a pickled copy. Yields the spec that _attach_shared needs to map the block in a worker. The block is freed on exit.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    try:
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        yield shm.name, array.shape, array.dtype.str
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _attach_shared(specs):
+    """
+    A pool initializer that maps the shared memory blocks described by specs (a dict of name -> spec from
+    _shared_array) into _worker_arrays.
+    """
+    for key, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_arrays[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _restart_worker(args):
+    """
+    Runs one seeded restart on the shared points in a pool worker.
+    :return: centrds, inertia : the final centroids and the inertia of the points assigned to them
+    """
+    k, seed_seq, iterations, method, backend, tol, moved_tol, empty = args
+    points = _worker_arrays['points'][1]
+    initial = pick_initial_centroids(k, points, method=method, seed=np.random.default_rng(seed_seq))
+    centrds, _ = create_clusters(k, initial, points, iterations, backend=backend, tol=tol, moved_tol=moved_tol,
+                                 empty=empty)
+    return centrds, float(assign_points(points, centrds)[1].sum())
+
+
+def parallel_restarts(k, data_points, restarts, iterations, workers=None, seed=None, method='kmeans++',
+                      backend='numpy', tol=0.0, moved_tol=0, empty='farthest'):
+    """
+    Runs create_clusters from several independently seeded starts at once over a process pool and keeps the result
+    with the lowest inertia. The points are put in shared memory once rather than pickled to every worker. Each
+    restart's seed is spawned from seed, so the result is the same for a given seed whatever the number of workers.
+    :param: k : the number of clusters to be produced
+    :param: data_points : a list of points or an (n, d) array
+    :param: restarts : the number of seeded starts to run
+    :param: iterations : the maximum number of iterations per start (see create_clusters)
+    :param: workers : the number of processes, os.cpu_count() when None
+    :param: seed : an int seed for the whole run
+    :param: method : the seeding method passed to pick_initial_centroids
+    :param: backend, tol, moved_tol, empty : passed to create_clusters
+    :return: centrds, clusters, inertia : the best run's centroids, its cluster index lists and its inertia
+    """
+    points = as_point_array(data_points)
+    seeds = np.random.SeedSequence(seed).spawn(restarts)
+    tasks = [(k, seed_seq, iterations, method, backend, tol, moved_tol, empty) for seed_seq in seeds]
+
+    with _shared_array(points) as spec:
+        with multiprocessing.Pool(workers, initializer=_attach_shared, initargs=({'points': spec},)) as pool:
+            results = pool.map(_restart_worker, tasks)
+
+    # min keeps the first of equal inertias, so ties go to the lowest restart number
+    centrds, inertia = min(results, key=lambda result: result[1])
+    labels, _ = assign_points(points, centrds)
+    return centrds, labels_to_clusters(labels, k), inertia
+
+
+def _shard_worker(args):
+    """
+    Assigns one shard of the shared points to the given centroids.
+    :return: labels, sums, counts, inertia : the labels of the shard's points, the per-cluster coordinate sums and point
+             counts of the shard, and its inertia
+    """
+    start, stop, centrds, distance = args
+    points = _worker_arrays['points'][1][start:stop]
+    labels, sq_dists = assign_points(points, centrds, distance=distance)
+
+    sums = np.zeros_like(centrds)
+    np.add.at(sums, labels, points)
+    return labels, sums, np.bincount(labels, minlength=len(centrds)), float(sq_dists.sum())
+
+
+def sharded_clusters(k, centrds, data_points, iterations, workers=None, **kwargs):
+    """
+    Runs a single create_clusters fit with the assignment step split across a process pool. The points live in shared
+    memory, each worker assigns one fixed, contiguous shard, and the per-cluster partial sums of the shards are merged in
+    shard order, so results are deterministic for a given number of workers.
+    :param: k : the number of clusters to be produced
+    :param: centrds : the initial centroids
+    :param: data_points : a list of points or an (n, d) array
+    :param: iterations : the maximum number of iterations
+    :param: workers : the number of processes (and shards), os.cpu_count() when None
+    :param: kwargs : tol, moved_tol, callback, return_history, empty and distance, passed to create_clusters
+    :return: the same values as create_clusters
+    """
+    points = as_point_array(data_points)
+    workers = workers or os.cpu_count()
+    bounds = np.linspace(0, len(points), workers + 1).astype(int)
+
+    with _shared_array(points) as spec:
+        with multiprocessing.Pool(workers, initializer=_attach_shared, initargs=({'points': spec},)) as pool:
+
+            def step(k, centrds, points, state):
+                distance = state.get('distance')
+                tasks = [(start, stop, centrds, distance) for start, stop in zip(bounds[:-1], bounds[1:])]
+                labels, sums, counts, inertia = [], np.zeros_like(centrds), np.zeros(k, dtype=np.int64), 0.0
+                for shard_labels, shard_sums, shard_counts, shard_inertia in pool.map(_shard_worker, tasks):
+                    labels.append(shard_labels)
+                    sums += shard_sums
+                    counts += shard_counts
+                    inertia += shard_inertia
+
+                nonempty = counts > 0
+                sums[nonempty] /= counts[nonempty, np.newaxis]
+                return np.concatenate(labels), inertia, sums
+
+            return create_clusters(k, centrds, points, iterations, backend=step, **kwargs)
+
+
+def _add_centroids(points, centrds, extra, rng):
+    """
+    Adds extra centroids to an existing set by k-means++ D^2 sampling (see _d2_sample) against the centroids already
+    there. Used to warm start a fit with k + extra clusters from a fit with k.
+    :return: a (k + extra, d) array of centroids
+    """
+    _, min_sq = assign_points(points, centrds)
+    return np.vstack([centrds, points[_d2_sample(points, extra, rng, min_sq=min_sq)]])
+
+
+def _pairwise_dists(points):
+    """
+    The (m, m) Euclidean distance matrix of a set of points from the Gram matrix, |x_i|^2 + |x_j|^2 - 2 x_i . x_j,
+    so only O(m^2) memory is needed rather than the (m, m, d) difference array. The points are centered first to
+    limit cancellation, and the squared distances are clipped at 0 before the square root.
+    """
+    centered = points - points.mean(axis=0)
+    sq_norms = np.einsum('ij,ij->i', centered, centered)
+    sq_dists = sq_norms[:, np.newaxis] + sq_norms[np.newaxis, :] - 2 * (centered @ centered.T)
+    np.maximum(sq_dists, 0, out=sq_dists)
+    np.fill_diagonal(sq_dists, 0)
+    return np.sqrt(sq_dists, out=sq_dists)
+
+
+def silhouette_score(sample_dists, sample_labels, k):
+    """
+    The mean silhouette coefficient of a set of points from their pairwise distances. For each point a is the mean
+    distance to the other points in its cluster and b the smallest mean distance to the points of another cluster, and
+    the coefficient is (b - a) / max(a, b), or 0 for a point alone in its cluster. The per-cluster distance sums come
+    from one matrix product with a one-hot label matrix.
+    :param: sample_dists : an (m, m) array of pairwise distances
+    :param: sample_labels : the cluster of each of the m points
+    :param: k : the number of clusters
+    :return: the mean silhouette coefficient as a float
+    """
+    one_hot = np.zeros((len(sample_labels), k))
+    one_hot[np.arange(len(sample_labels)), sample_labels] = 1
+    sums = sample_dists @ one_hot
+    counts = one_hot.sum(axis=0)
+    rows = np.arange(len(sample_labels))
+
+    own = counts[sample_labels]
+    a = sums[rows, sample_labels] / np.maximum(own - 1, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+    means[:, counts == 0] = np.inf
+    means[rows, sample_labels] = np.inf
+    b = means.min(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(own > 1, (b - a) / np.maximum(a, b), 0.0)
+    return float(np.nan_to_num(scores, nan=0.0, posinf=0.0, neginf=0.0).mean())
+
+
+def davies_bouldin_score(centrds, labels, dists):
+    """
+    The Davies-Bouldin index: the mean over clusters of the largest (s_i + s_j) / |c_i - c_j| over the other clusters,
+    where s_i is the mean distance from the points of cluster i to its centroid. Lower is better.
+    :param: centrds : a (k, d) array of centroids
+    :param: labels : the cluster of every point
+    :param: dists : the distance from every point to its own centroid
+    :return: the index as a float
+    """
+    k = len(centrds)
+    counts = np.bincount(labels, minlength=k)
+    scatter = np.bincount(labels, weights=dists, minlength=k) / np.maximum(counts, 1)
+    diff = centrds[:, np.newaxis, :] - centrds[np.newaxis, :, :]
+    center_dists = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+    np.fill_diagonal(center_dists, np.inf)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = (scatter[:, np.newaxis] + scatter[np.newaxis, :]) / center_dists
+    ratios[~np.isfinite(ratios)] = 0.0
+    return float(ratios.max(axis=1).mean())
+
+
+def sweep_k(data_points, k_values, iterations, seed=None, silhouette_sample=2000, backend='numpy', tol=0.0,
+            moved_tol=0, method='kmeans++', empty='farthest'):
+    """
+    Clusters the same data for a range of k and scores each fit, to help choose k (e.g. by the elbow of the inertia
+    curve or the best silhouette). The work is shared across k: the points are converted to an array once, the silhouette
+    is computed on one random sample of the points whose pairwise distance matrix is built once, and every fit after the
+    first is warm started from the previous fit's centroids plus new ones picked by k-means++ sampling.
+    :param: data_points : a list of points or an (n, d) array
+    :param: k_values : the values of k to try; they are run in ascending order
+    :param: iterations : the maximum number of iterations per fit (see create_clusters)
+    :param: seed : an int seed for the seeding and the silhouette sample
+    :param: silhouette_sample : the number of points the silhouette is computed on (all of them if there are fewer)
+    :param: backend, tol, moved_tol, empty : passed to create_clusters
+    :param: method : the seeding method (see pick_initial_centroids) of the first, smallest k
+    :return: a list with one dict per k holding 'k', 'inertia', 'silhouette', 'davies_bouldin', 'iterations', 'time'
+             and the fitted 'centroids'
+    """
+    points = as_point_array(data_points)
+    rng = np.random.default_rng(seed)
+
+    sample = np.arange(len(points))
+    if len(points) > silhouette_sample:
+        sample = np.sort(rng.choice(len(points), size=silhouette_sample, replace=False))
+    sample_dists = _pairwise_dists(points[sample].astype(np.float64))
+
+    rows = []
+    centrds = None
+    for k in sorted(k_values):
+        start = time.perf_counter()
+        if centrds is None:
+            initial = pick_initial_centroids(k, points, method=method, seed=rng)
+        else:
+            initial = _add_centroids(points, centrds, k - len(centrds), rng)
+        centrds, _, history = create_clusters(k, initial, points, iterations, backend=backend, tol=tol,
+                                              moved_tol=moved_tol, return_history=True, empty=empty)
+        labels, sq_dists = assign_points(points, centrds)
+
+        rows.append({'k': k, 'inertia': float(sq_dists.sum()),
+                     'silhouette': silhouette_score(sample_dists, labels[sample], k) if k > 1 else 0.0,
+                     'davies_bouldin': davies_bouldin_score(centrds, labels, np.sqrt(sq_dists)),
+                     'iterations': len(history), 'time': time.perf_counter() - start, 'centroids': centrds})
+    return rows
+
+
+def incremental_state(data_points, centrds):
+    """
+    Builds the state that update_clusters needs to keep a fit up to date as new points arrive: the centroids, the
+    per-cluster point counts and coordinate sums, and for every point its label and Hamerly style bounds (the distance
+    to its own centroid and to the second closest one). The bounds are stored relative to running totals of how far
+    each centroid, and the furthest moving one, has drifted (see _bound_gaps), so they never have to be rewritten when
+    the centroids move, and the gap between each point's bounds is kept in sorted runs per cluster (see _add_gaps) so
+    that the points whose bounds may have crossed are found without looking at every point.
+    :param: data_points : a list of points or an (n, d) array
+    :param: centrds : the fitted centroids, e.g. from create_clusters
+    :return: a dict with the keys 'centroids', 'counts', 'sums', 'labels', 'gaps' (the stored gap between each point's
+             bounds), 'cluster_drift' (the total drift of each centroid), 'max_drift' (the total of the largest drift of
+             each move), 'runs' (the sorted runs of gaps of each cluster), 'bounds_at' (the centroids the bounds were
+             last made exact against), 'num_points', 'drift' (how far the centroids have moved since the last full
+             fit) and 'buffers' (the arrays that 'labels' and 'gaps' are views of, which update_clusters grows
+             geometrically)
+    """
+    points = as_point_array(data_points)
+    centrds = np.array(centrds, dtype=np.float64)
+    k = len(centrds)
+    labels, sq_nearest, sq_second = _nearest_two(points, centrds)
+
+    sums = np.zeros_like(centrds)
+    np.add.at(sums, labels, points)
+    state = {'centroids': centrds, 'counts': np.bincount(labels, minlength=k), 'sums': sums,
+             'cluster_drift': np.zeros(k), 'max_drift': 0.0, 'runs': [[] for _ in range(k)],
+             'bounds_at': centrds.copy(), 'num_points': len(points), 'drift': 0.0}
+    gaps = _bound_gaps(state, labels, sq_nearest, sq_second)
+    state.update(labels=labels, gaps=gaps, buffers=(labels, gaps))
+    _add_gaps(state['runs'], np.arange(len(points)), labels, gaps)
+    return state
+
+
+def _bound_gaps(state, labels, sq_nearest, sq_second):
+    """
+    The stored bound gaps of points whose bounds were just computed. With D the total drift of a point's centroid and M
+    the total of the largest drifts, its upper bound u is kept as u - D and its lower bound l as l + M: the real bounds
+    are then always the stored ones plus the current D and minus the current M, and they can only have crossed once
+    the gap (l + M) - (u - D) is at most the current D + M of its cluster. The gap is made smaller by the relative
+    HAMERLY_MARGIN of l so that rounding never hides a crossing, and is infinite when there is a single centroid.
+    """
+    upper, lower = np.sqrt(sq_nearest), np.sqrt(sq_second)
+    with np.errstate(invalid='ignore'):
+        gaps = (lower + state['max_drift']) - (upper - state['cluster_drift'][labels]) - HAMERLY_MARGIN * lower
+    return np.where(np.isfinite(lower), gaps, np.inf)
+
+
+def _add_drift(state, moves):
+    """
+    Adds the distance each centroid moved (moves is the (k, d) array of their displacements) to the running totals that
+    loosen every stored bound at once.
+    """
+    drift = np.sqrt((moves ** 2).sum(axis=1))
+    state['cluster_drift'] += drift
+    state['max_drift'] += float(drift.max())
+
+
+def _add_gaps(runs, ids, labels, gaps):
+    """
+    Adds the points ids to the per-cluster runs of (gap, point id) arrays sorted by gap. The points of each cluster
+    become a new run, which is merged with the run before it while that one is at most twice as long, so a cluster
+    keeps O(log n) runs and every entry is re-sorted O(log n) times. Entries for points that have since been given new
+    bounds or moved to another cluster are dropped when their run is merged.
+    :param: runs : the list of k lists of runs, modified in place
+    :param: ids : the points to add
+    :param: labels, gaps : the current label and stored gap of every point
+    """
+    batch_labels = labels[ids]
+    order = np.lexsort((gaps[ids], batch_labels))
+    ids, batch_labels = ids[order], batch_labels[order]
+    starts = np.flatnonzero(np.diff(batch_labels, prepend=-1))
+
+    for start, stop in zip(starts, np.append(starts[1:], len(ids))):
+        c_id = batch_labels[start]
+        cluster_runs = runs[c_id]
+        cluster_runs.append((gaps[ids[start:stop]], ids[start:stop]))
+        while len(cluster_runs) > 1 and len(cluster_runs[-2][0]) <= 2 * len(cluster_runs[-1][0]):
+            (gaps_a, ids_a), (gaps_b, ids_b) = cluster_runs.pop(-2), cluster_runs.pop()
+            merged_gaps, merged_ids = np.concatenate([gaps_a, gaps_b]), np.concatenate([ids_a, ids_b])
+            current = (labels[merged_ids] == c_id) & (gaps[merged_ids] == merged_gaps)
+            merged_gaps, merged_ids = merged_gaps[current], merged_ids[current]
+            order = np.argsort(merged_gaps, kind='stable')
+            cluster_runs.append((merged_gaps[order], merged_ids[order]))
+
+
+def _pop_crossed(runs, thresholds, labels, gaps):
+    """
+    Removes from the runs and returns the points whose bounds may have crossed, i.e. whose stored gap is at most the
+    threshold (D + M) of their cluster. The runs are sorted, so each one needs a single binary search and the work is
+    proportional to the number of points found rather than to the number of points.
+    :return: a sorted array of point ids
+    """
+    found_gaps, found_ids, found_labels = [], [], []
+    for c_id, cluster_runs in enumerate(runs):
+        kept = []
+        for run_gaps, run_ids in cluster_runs:
+            cut = int(np.searchsorted(run_gaps, thresholds[c_id], side='right'))
+            if cut:
+                found_gaps.append(run_gaps[:cut])
+                found_ids.append(run_ids[:cut])
+                found_labels.append(np.full(cut, c_id))
+            if cut < len(run_gaps):
+                kept.append((run_gaps[cut:], run_ids[cut:]))
+        runs[c_id] = kept
+    if not found_ids:
+        return np.empty(0, dtype=np.intp)
+
+    found_gaps, found_ids = np.concatenate(found_gaps), np.concatenate(found_ids)
+    current = (labels[found_ids] == np.concatenate(found_labels)) & (gaps[found_ids] == found_gaps)
+    return np.unique(found_ids[current])
+
+
+def _point_rows(data_points, ids, dimensions):
+    """
+    The rows ids (an index array or a slice) of data_points as an (m, d) float array, without converting all of a list
+    of points to an array first.
+    """
+    if isinstance(data_points, np.ndarray):
+        return as_point_array(data_points[ids])
+    rows = data_points[ids] if isinstance(ids, slice) else [data_points[i] for i in ids]
+    return np.array(rows, dtype=np.float64).reshape(len(rows), dimensions)
+
+
+def _grow(buffer, size):
+    """
+    Returns buffer if it can hold size entries, or else a copy of it with at least double the capacity, so that
+    appending to a per-point array costs amortized O(1) copies per point rather than a copy of the whole array.
+    """
+    if len(buffer) >= size:
+        return buffer
+    grown = np.empty(max(size, 2 * len(buffer)), dtype=buffer.dtype)
+    grown[:len(buffer)] = buffer
+    return grown
+
+
+def update_clusters(state, data_points, refit_tol=None, iterations=100):
+    """
+    Updates a fit in place for the rows appended to data_points since the state was built or last updated. Only the new
+    points are assigned in full. The centroids are then moved to the running means kept in the state, and the earlier
+    points are re-assigned only when their bounds show the centroid drift could have changed their cluster. The drift
+    is added to running totals rather than to every bound, and only the rows that are looked at are read from
+    data_points, so the work grows with the new data and the points rechecked rather than the whole history. Once the
+    total drift since the last full fit passes refit_tol, create_clusters is run over all the points from the current
+    centroids and the state rebuilt.
+    :param: state : a dict from incremental_state
+    :param: data_points : the full data set, i.e. the old points followed by the new ones
+    :param: refit_tol : the total centroid drift that triggers a full refit; never refit when None
+    :param: iterations : the maximum number of iterations of a full refit
+    :return: a dict with 'new' (points added), 'rechecked' (points whose distances were recomputed after the centroids
+             moved), 'moved' (points that changed cluster), 'drift' (largest centroid movement) and 'refit' (whether a
+             full fit ran)
+    """
+    centrds, old_count = state['centroids'], state['num_points']
+    k, dimensions = centrds.shape
+    new_points = _point_rows(data_points, slice(old_count, None), dimensions)
+    num_points = old_count + len(new_points)
+
+    # the per-point arrays are views of buffers that grow geometrically, so appending rarely copies the history
+    buffers = tuple(_grow(buffer, num_points) for buffer in state['buffers'])
+    labels, gaps = (buffer[:num_points] for buffer in buffers)
+
+    # account for the last move of the centroids, then bound and add in the new points
+    _add_drift(state, centrds - state['bounds_at'])
+    new_labels, sq_nearest, sq_second = _nearest_two(new_points, centrds)
+    labels[old_count:] = new_labels
+    gaps[old_count:] = _bound_gaps(state, new_labels, sq_nearest, sq_second)
+    _add_gaps(state['runs'], np.arange(old_count, num_points), labels, gaps)
+    np.add.at(state['sums'], new_labels, new_points)
+    state['counts'] += np.bincount(new_labels, minlength=k)
+
+    # move the centroids to the new means; the running totals loosen every bound by how far they moved
+    nonempty = state['counts'] > 0
+    new_centrds = centrds.copy()
+    new_centrds[nonempty] = state['sums'][nonempty] / state['counts'][nonempty, np.newaxis]
+    _add_drift(state, new_centrds - centrds)
+
+    # only points whose bounds may have crossed might now be closer to another centroid
+    recheck = _pop_crossed(state['runs'], state['cluster_drift'] + state['max_drift'], labels, gaps)
+    recheck_points = _point_rows(data_points, recheck, dimensions)
+    moved_labels, sq_nearest, sq_second = _nearest_two(recheck_points, new_centrds)
+    changed = moved_labels != labels[recheck]
+    moved = recheck[changed]
+    if len(moved):
+        np.subtract.at(state['sums'], labels[moved], recheck_points[changed])
+        np.add.at(state['sums'], moved_labels[changed], recheck_points[changed])
+        np.subtract.at(state['counts'], labels[moved], 1)
+        np.add.at(state['counts'], moved_labels[changed], 1)
+    labels[recheck] = moved_labels
+    gaps[recheck] = _bound_gaps(state, moved_labels, sq_nearest, sq_second)
+    _add_gaps(state['runs'], recheck, labels, gaps)
+
+    # the bounds now refer to new_centrds; the centroids themselves move once more to the means after the moves
+    nonempty = state['counts'] > 0
+    moved_centrds = new_centrds.copy()
+    moved_centrds[nonempty] = state['sums'][nonempty] / state['counts'][nonempty, np.newaxis]
+    state.update(centroids=moved_centrds, labels=labels, gaps=gaps, bounds_at=new_centrds, num_points=num_points,
+                 buffers=buffers)
+    state['drift'] += float(np.sqrt(((moved_centrds - centrds) ** 2).sum(axis=1)).max())
+
+    report = {'new': len(new_points), 'rechecked': len(recheck), 'moved': len(moved),
+              'drift': float(np.sqrt(((moved_centrds - centrds) ** 2).sum(axis=1)).max()), 'refit': False}
+    if refit_tol is not None and state['drift'] > refit_tol:
+        points = as_point_array(data_points)
+        refit, _ = create_clusters(k, moved_centrds, points, iterations)
+        state.update(incremental_state(points, refit))
+        report['refit'] = True
+    return report
+
+
+
+
+class ClusterModel:
+    """
+    A fitted clustering that can be saved, loaded and used to label new points without refitting. It holds the
+    centroids, the names of the features in the order the points use them, the scaling applied to raw points before
+    clustering (x -> (x - offset) / scale; the identity unless given) and a dict of fit metadata.
+    """
+
+    def __init__(self, centroids, columns=None, offset=None, scale=None, metadata=None):
+        """
+        :param: centroids : a (k, d) array of centroids, in scaled units
+        :param: columns : the feature names, in point order
+        :param: offset, scale : arrays of length d mapping raw points to scaled ones; no scaling when None
+        :param: metadata : a dict of JSON serialisable facts about the fit (k, iterations, inertia, ...)
+        """
+        self.centroids = np.array(centroids, dtype=np.float64)
+        dimensions = self.centroids.shape[1]
+        self.columns = list(columns) if columns is not None else [str(i) for i in range(dimensions)]
+        self.offset = np.zeros(dimensions) if offset is None else np.asarray(offset, dtype=np.float64)
+        self.scale = np.ones(dimensions) if scale is None else np.asarray(scale, dtype=np.float64)
+        self.metadata = dict(metadata or {})
+        self._half_sq_norms = 0.5 * np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+    def transform(self, data_points):
+        """
+        Scales raw points the same way the points were scaled for the fit, returning a new array.
+        :return: an (n, d) float64 array
+        """
+        return scale_points(np.array(data_points, dtype=np.float64), self.offset, self.scale)
+
+    def inverse_transform(self, data_points):
+        """
+        Maps scaled points, such as self.centroids, back to the raw units of the features.
+        :return: an (n, d) float64 array
+        """
+        return unscale_points(data_points, self.offset, self.scale)
+
+    @_profiled('predict')
+    def predict(self, data_points, chunk_rows=ASSIGN_CHUNK_ROWS):
+        """
+        Labels raw points with the index of their nearest centroid. Uses argmin(|c|^2 / 2 - x . c), which needs one
+        matrix product per block and no (rows, k, d) temporary, so it is much faster than assign_points; labels can
+        differ from assign_points only for points (almost exactly) tied between two centroids.
+        :param: data_points : a list of points or an (n, d) array in raw units, with the features in self.columns order
+        :param: chunk_rows : the number of points labelled per block
+        :return: a 1D integer array of cluster ids
+        """
+        points = as_point_array(data_points)
+        labels = np.empty(len(points), dtype=np.intp)
+        for start in range(0, len(points), chunk_rows):
+            block = (points[start:start + chunk_rows] - self.offset) / self.scale
+            labels[start:start + chunk_rows] = (self._half_sq_norms - block @ self.centroids.T).argmin(axis=1)
+        return labels
+
+    def save(self, path):
+        """
+        Writes the model to an uncompressed .npz file, which np.load can read back without unpickling anything.
+        :param: path : the file to write
+        """
+        np.savez(path, centroids=self.centroids, columns=np.array(self.columns, dtype=str), offset=self.offset,
+                 scale=self.scale, metadata=np.array(json.dumps(self.metadata)))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a model written by save.
+        :param: path : the .npz file to read
+        :return: a ClusterModel
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['centroids'], data['columns'].tolist(), data['offset'], data['scale'],
+                       json.loads(str(data['metadata'])))
+
+
+def _cluster_labels(clusters, num_points):
+    """
+    Turns a list of cluster index lists back into a label vector, the inverse of labels_to_clusters.
+    :return: a 1D integer array where labels[i] is the cluster that point i belongs to, or -1 if it is in no cluster
+    """
+    labels = np.full(num_points, -1, dtype=np.intp)
+    for c_id, cluster in enumerate(clusters):
+        labels[cluster] = c_id
+    return labels
+
+
+@_profiled('render')
+def visualize_clusters(c, clusters, data_points, categories, sphere=False, rotate=True, save_path=None,
+                       max_points=None, seed=None):
     """
     A function which handles the visualization portion of the cluster analysis. Uses matplotlib and numpy to handle 3D
     graphing. Here it has been used to graph clusters determined based on Calories, Protein intake, and Work Fraction
-    (i.e. = actual/expected work). The graph rotates to give a good perspective on the clusters. If show=True then also
+    (i.e. = actual/expected work). The graph rotates to give a good perspective on the clusters. If sphere=True then also
     plot wireframe spheres centered at the centroids of each cluster with a radius that is the distance from the centroid
     to the furthest point.
 
+    The plot is built from array slices of the points, one scatter call per cluster, and the radii are computed in a
+    single vectorized pass. If save_path is given the plot is rendered offline with the headless Agg backend and never
+    shown: to a .gif or .mp4 animation of the rotation if rotate is True and the path has one of those extensions,
+    otherwise to a still image. Any number of clusters can be drawn.
+
     Credit for wireframe sphere: https://stackoverflow.com/questions/40460960/how-to-plot-a-sphere-when-we-are-given-a-central-point-and-a-radius-size
 
+    :param: c : the centroids of the clusters
     :param: clusters : list of lists of integers which represent indexes of points in each cluster (the indexes refer to
                        points in data_points)
     :param: data_points : a list of tuples which each represent one of the data points; for this function it is assumed
@@ -186,59 +1966,203 @@ def visualize_clusters(c, clusters, data_points, categories, sphere=False):
     :param: categories : a tuple of strings which are the categories of the coordinates being plotted
                          (i.e. position 0 = x label, 1 = y label, 2 = z label)
     :param: sphere : a boolean that determines whether or not to display wireframe spheres around the clusters (centered at each cluster's centroid)
-    :return: None
+    :param: rotate : whether to rotate the graph (on screen, or as an animation when saving); without rotate and
+                     save_path the plot is shown with plt.show(), which blocks until its window is closed
+    :param: save_path : a file to render the plot to instead of showing it
+    :param: max_points : if given, draw a random sample of at most this many points (the spheres still use every point)
+    :param: seed : the seed for the sample drawn when max_points is given
+    :return: the matplotlib Figure
     """
-    
-    fig = plt.figure()
-    # ax = fig.add_subplot(111, projection='3d')
-    ax = fig.gca(projection='3d')
+    points = as_point_array(data_points)
+    c = np.asarray(c, dtype=np.float64)
+    k = len(clusters)
+    labels = _cluster_labels(clusters, len(points))
+
+    # only the points listed in clusters are drawn, as in the original
+    listed = np.flatnonzero(labels >= 0)
+
+    # the radius of each sphere is the distance from the centroid to the furthest point in its cluster
+    diff = points[listed] - c[labels[listed]]
+    radii = np.zeros(k)
+    np.maximum.at(radii, labels[listed], np.sqrt(np.einsum('ij,ij->i', diff, diff)))
+
+    shown = listed
+    if max_points is not None and len(listed) > max_points:
+        shown = np.sort(np.random.default_rng(seed).choice(listed, size=max_points, replace=False))
+
+    # matplotlib is only imported when something is plotted, so importing this module stays fast for batch jobs
+    import matplotlib
+    from mpl_toolkits.mplot3d import Axes3D
+    if save_path is None:
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+    else:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure()
+        FigureCanvasAgg(fig)
+
+    ax = fig.add_subplot(111, projection='3d')
     ax.set_xlabel(f'{categories[0]}')
     ax.set_ylabel(f'{categories[1]}')
     ax.set_zlabel(f'{categories[2]}')
 
-    # color identifiers for clusters -- supports up to 5 clusters now
-    colors = ["red", 'blue', 'green', 'orange', 'yellow']
-    c_id = 0
-
-    # for each cluster
-    for cluster in clusters:
-        xs = np.array([])
-        ys = np.array([])
-        zs = np.array([])
-        mx = 0
-        # determine the collective xs, ys, and zs for the points in each cluster
-        for point_id in cluster:
-            xs = np.append(xs, np.double(data_points[point_id][0]))
-            ys = np.append(ys, np.double(data_points[point_id][1]))
-            zs = np.append(zs, np.double(data_points[point_id][2]))
-
-            # calc dist from each cluster centroid to each point, find the max (furthest point from centroid)
-            dist = nd_dist(c[c_id], data_points[point_id])
-            if dist > mx:
-                mx = dist
-
-        # find sphere outline for wireframe
-        u, v = np.mgrid[0:2*np.pi:12*1j, 0:np.pi:20*1j]
-        sphere_x = c[c_id][0] + mx * np.cos(u) * np.sin(v)
-        sphere_y = c[c_id][1] + mx * np.sin(u) * np.sin(v)
-        sphere_z = c[c_id][2] + mx * np.cos(v)
+    # the original five colors for small k, and evenly spaced colors from a colormap beyond that
+    if k <= len(CLUSTER_COLORS):
+        colors = CLUSTER_COLORS[:k]
+    else:
+        colors = [tuple(rgba) for rgba in matplotlib.colormaps['turbo'](np.linspace(0, 1, k))]
+
+    # find sphere outline for wireframe
+    u, v = np.mgrid[0:2*np.pi:12*1j, 0:np.pi:20*1j]
+
+    shown_labels = labels[shown]
+    for c_id in range(k):
+        cluster_pts = points[shown[shown_labels == c_id]]
 
         # graph the points for the cluster
-        ax.scatter(xs, ys, zs, c=f'{colors[c_id]}')
+        ax.scatter(cluster_pts[:, 0], cluster_pts[:, 1], cluster_pts[:, 2], color=colors[c_id])
 
         # plot wire spheres around data clusters
         if sphere:
-            ax.plot_wireframe(sphere_x, sphere_y, sphere_z, color=f'{colors[c_id]}')
+            sphere_x = c[c_id][0] + radii[c_id] * np.cos(u) * np.sin(v)
+            sphere_y = c[c_id][1] + radii[c_id] * np.sin(u) * np.sin(v)
+            sphere_z = c[c_id][2] + radii[c_id] * np.cos(v)
+            ax.plot_wireframe(sphere_x, sphere_y, sphere_z, color=colors[c_id])
+
+    if save_path is not None:
+        extension = os.path.splitext(save_path)[1].lower()
+        if rotate and extension in ('.gif', '.mp4'):
+            from matplotlib.animation import FuncAnimation
+            animation = FuncAnimation(fig, lambda angle: ax.view_init(30, angle), frames=range(0, 360, 2))
+            animation.save(save_path, writer='pillow' if extension == '.gif' else 'ffmpeg')
+        else:
+            fig.savefig(save_path)
+        return fig
 
+    # the 3D rotation of the graph, or a still window that stays open until it is closed
+    if rotate:
+        for angle in range(0, 360):
+            ax.view_init(30, angle)
+            plt.draw()
+            plt.pause(.001)
+    else:
+        plt.show()
+    return fig
 
-        # graph the points for the cluster
-        ax.scatter(xs, ys, zs, c=f'{colors[c_id]}')
 
-        c_id += 1
+def main(argv=None):
+    """
+    The command line entry point: clusters a .csv file without any plotting unless a plot is asked for, and writes the
+    labels, centroids, metrics and model to files. Run python cluster.py --help for the options, e.g.
+
+        python cluster.py bulkData.csv --columns Calories "PRO (g)" "Work Fraction" --k 5 --scale zscore \
+            --labels labels.csv --centroids centroids.csv --metrics metrics.json --plot clusters.png
+
+    :param: argv : the arguments, sys.argv[1:] when None
+    :return: the metrics dict
+    """
+    parser = argparse.ArgumentParser(description='k-means cluster analysis of a .csv file.')
+    parser.add_argument('csv', help='the .csv file to cluster')
+    parser.add_argument('--columns', nargs='+', default=None, help='the header names to cluster on (default: all)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--k', type=int, default=5, help='the number of clusters (default: 5)')
+    group.add_argument('--k-range', type=int, nargs=2, metavar=('MIN', 'MAX'),
+                       help='sweep k from MIN to MAX and keep the k with the best silhouette')
+    parser.add_argument('--iterations', type=int, default=100, help='the maximum number of iterations')
+    parser.add_argument('--seeding', choices=SEEDING_METHODS, default='kmeans++', help='how to pick initial centroids')
+    parser.add_argument('--seed', type=int, default=None, help='the random seed, for reproducible runs')
+    parser.add_argument('--backend', choices=sorted(CLUSTER_BACKENDS), default='numpy', help='the clustering engine')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes to use: restarts run in parallel, or one fit is sharded across them')
+    parser.add_argument('--restarts', type=int, default=1, help='independently seeded fits to run, keeping the best')
+    parser.add_argument('--scale', choices=SCALING_METHODS, default=None, help='scale the features before clustering')
+    parser.add_argument('--empty', choices=EMPTY_STRATEGIES, default='farthest', help='how to reseed empty clusters')
+    parser.add_argument('--float32', action='store_true', help='store the points in float32 to halve memory')
+    parser.add_argument('--cache', action='store_true', help='read the .csv through its binary columnar cache')
+    parser.add_argument('--labels', help='write the cluster of every row to this .csv file')
+    parser.add_argument('--centroids', help='write the centroids (in the original units) to this .csv file')
+    parser.add_argument('--metrics', help='write the fit metrics to this .json file')
+    parser.add_argument('--model', help='write the fitted ClusterModel to this .npz file')
+    parser.add_argument('--plot', help='render the first three columns to this image (or .gif) file')
+    parser.add_argument('--profile', help='write per-stage timings and counters to this .json file (or cProfile '
+                                          'statistics to a .prof file)')
+    args = parser.parse_args(argv)
+    # reject combinations that would otherwise quietly run a different setup than the one asked for
+    if args.k_range is not None and (args.workers > 1 or args.restarts > 1):
+        parser.error('--k-range runs one fit per k in this process; it does not take --workers or --restarts')
+    if args.workers > 1 and args.restarts == 1 and args.backend != 'numpy':
+        parser.error(f"--workers shards one fit with the 'numpy' backend only, not {args.backend!r}; "
+                     "use --restarts to run several fits in parallel")
+    if args.plot and len(csv_columns(args.csv, args.columns)[0]) < 3:
+        parser.error('--plot draws the first three columns, so it needs at least three --columns')
+    if args.profile:
+        # keep a profiler already started through CLUSTER_PROFILE rather than replacing it
+        profiler = _profiler or enable_profiling(cprofile=args.profile.endswith('.prof'))
+
+    start = time.perf_counter()
+    points, columns = load_points(args.csv, args.columns, dtype=np.float32 if args.float32 else np.float64,
+                                  cache=args.cache)
+    offset = scale = None
+    if args.scale is not None:
+        offset, scale = fit_scaler(points, args.scale)
+        scale_points(points, offset, scale)
+
+    metrics = {'csv': args.csv, 'columns': columns, 'rows': len(points), 'scale': args.scale}
+    if args.k_range is not None:
+        sweep = sweep_k(points, range(args.k_range[0], args.k_range[1] + 1), args.iterations, seed=args.seed,
+                        backend=args.backend, method=args.seeding, empty=args.empty)
+        best = max(sweep, key=lambda row: row['silhouette'])
+        centrds, k = best['centroids'], best['k']
+        metrics['sweep'] = [{key: value for key, value in row.items() if key != 'centroids'} for row in sweep]
+    else:
+        k = args.k
+        if args.restarts > 1:
+            centrds, _, _ = parallel_restarts(k, points, args.restarts, args.iterations, workers=args.workers,
+                                              seed=args.seed, method=args.seeding, backend=args.backend,
+                                              empty=args.empty)
+        else:
+            initial = pick_initial_centroids(k, points, method=args.seeding, seed=args.seed)
+            if args.workers > 1:
+                centrds, _, history = sharded_clusters(k, initial, points, args.iterations, workers=args.workers,
+                                                       empty=args.empty, return_history=True)
+            else:
+                centrds, _, history = create_clusters(k, initial, points, args.iterations, backend=args.backend,
+                                                      empty=args.empty, return_history=True)
+            metrics['iterations'] = len(history)
+            metrics['history'] = history
+
+    labels, sq_dists = assign_points(points, centrds)
+    metrics.update(k=k, inertia=float(sq_dists.sum()), cluster_sizes=np.bincount(labels, minlength=k).tolist(),
+                   seconds=time.perf_counter() - start)
+
+    model = ClusterModel(centrds, columns, offset, scale, {key: metrics[key] for key in ('k', 'inertia', 'rows')})
+    raw_centrds = model.inverse_transform(centrds)
+    if args.labels:
+        np.savetxt(args.labels, labels, fmt='%d', header='cluster', comments='')
+    if args.centroids:
+        np.savetxt(args.centroids, raw_centrds, fmt='%.10g', delimiter=',', header=','.join(columns), comments='')
+    if args.model:
+        model.save(args.model)
+    if args.plot:
+        raw_points = points if scale is None else unscale_points(points, offset, scale)
+        visualize_clusters(raw_centrds[:, :3], labels_to_clusters(labels, k), raw_points[:, :3], columns[:3],
+                           sphere=True, save_path=args.plot)
+    if args.metrics:
+        with open(args.metrics, 'w') as fp:
+            json.dump(metrics, fp, indent=2)
+
+    if args.profile:
+        disable_profiling()
+        if args.profile.endswith('.prof'):
+            profiler.dump_stats(args.profile)
+        else:
+            profiler.to_json(args.profile)
+
+    print(f"clustered {len(points)} rows into {k} clusters in {metrics['seconds']:.3f}s, "
+          f"inertia {metrics['inertia']:.6g}")
+    return metrics
 
-    # the 3D rotation of the graph
-    for angle in range(0, 360):
-        ax.view_init(30, angle)
-        plt.draw()
-        plt.pause(.001)
 
+if __name__ == '__main__':
+    main()
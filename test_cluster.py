@@ -0,0 +1,410 @@
+"""
+Tests for cluster.py. Run with:
+
+    python -m pytest test_cluster.py
+"""
+import os
+import numpy as np
+import pytest
+
+import cluster
+
+
+def make_points(num_points=600, dimensions=3, k=4, seed=0):
+    """
+    Seeded, well separated Gaussian blobs, so that every backend settles on the same clustering.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-50, 50, size=(k, dimensions))
+    return centers[rng.integers(k, size=num_points)] + rng.normal(size=(num_points, dimensions))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_numpy_backend_matches_loop(seed):
+    points = make_points(seed=seed)
+    initial = cluster.pick_initial_centroids(4, points, seed=seed)
+    loop_centrds, loop_clusters = cluster.create_clusters(4, initial, [tuple(p) for p in points], 50, backend='loop',
+                                                          empty='keep')
+    numpy_centrds, numpy_clusters = cluster.create_clusters(4, initial, points, 50, backend='numpy', empty='keep')
+    assert numpy_clusters == loop_clusters
+    np.testing.assert_allclose(numpy_centrds, loop_centrds, rtol=1e-12, atol=1e-12)
+
+
+def test_assign_points_blocks_large_k_and_d():
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(3000, 50))
+    centrds = points[:100].copy()
+    labels, sq_dists = cluster.assign_points(points, centrds)
+    rows = cluster._block_rows(centrds, cluster.ASSIGN_CHUNK_ROWS)
+    assert rows * centrds.size * 8 <= cluster.ASSIGN_BLOCK_BYTES
+    full = ((points[:, np.newaxis, :] - centrds[np.newaxis, :, :]) ** 2).sum(axis=2)
+    np.testing.assert_array_equal(labels, full.argmin(axis=1))
+    np.testing.assert_allclose(sq_dists, full.min(axis=1))
+
+
+def test_minibatch_samples_the_whole_csv(tmp_path):
+    # a time-ordered log: the first half of the rows sit around (0, 0) and the second half around (20, 20)
+    rng = np.random.default_rng(0)
+    num_rows = 200000
+    points = rng.normal(scale=0.5, size=(num_rows, 2))
+    points[num_rows // 2:] += 20
+    path = tmp_path / 'log.csv'
+    np.savetxt(path, points, delimiter=',', header='x,y', comments='', fmt='%.6f')
+
+    initial = np.array([[5.0, 5.0], [15.0, 15.0]])
+    centrds, clusters = cluster.minibatch_clusters(2, initial, str(path), 100, batch_size=1024, seed=0)
+    np.testing.assert_allclose(np.sort(centrds, axis=0), [[0, 0], [20, 20]], atol=0.2)
+    assert sorted(len(ids) for ids in clusters) == [num_rows // 2, num_rows // 2]
+    # by default the cache lives in a temporary directory, so nothing is written next to the data
+    assert os.listdir(tmp_path) == ['log.csv']
+
+
+def test_minibatch_keeps_the_cache_where_asked(tmp_path):
+    data_dir, cache_dir = tmp_path / 'data', tmp_path / 'cache'
+    data_dir.mkdir()
+    path = data_dir / 'log.csv'
+    np.savetxt(path, make_points(), delimiter=',', header='x,y,z', comments='', fmt='%.6f')
+    data_dir.chmod(0o555)
+    try:
+        centrds, clusters = cluster.minibatch_clusters(4, make_points()[:4], str(path), 20, batch_size=100, seed=0,
+                                                       cache_dir=str(cache_dir))
+    finally:
+        data_dir.chmod(0o755)
+    assert sum(map(len, clusters)) == 600
+    assert 'meta.json' in os.listdir(cache_dir)
+    assert os.listdir(data_dir) == ['log.csv']
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_hamerly_backend_matches_numpy(seed):
+    points = make_points(num_points=2000, dimensions=4, k=12, seed=seed)
+    initial = cluster.pick_initial_centroids(12, points, seed=seed)
+    numpy_centrds, numpy_clusters, numpy_history = cluster.create_clusters(12, initial, points, 100, backend='numpy',
+                                                                           return_history=True)
+    hamerly_centrds, hamerly_clusters, hamerly_history = cluster.create_clusters(12, initial, points, 100,
+                                                                                 backend='hamerly', return_history=True)
+    assert hamerly_clusters == numpy_clusters
+    assert [record['moved'] for record in hamerly_history] == [record['moved'] for record in numpy_history]
+    np.testing.assert_allclose(hamerly_centrds, numpy_centrds, rtol=1e-12, atol=1e-12)
+    assert sum(record['skipped'] for record in hamerly_history) > 0
+
+
+def test_parallel_restarts_same_for_any_worker_count():
+    points = make_points(num_points=1500, k=5)
+    results = [cluster.parallel_restarts(5, points, 6, 50, workers=workers, seed=3) for workers in (1, 2, 3)]
+    for centrds, clusters, inertia in results[1:]:
+        np.testing.assert_array_equal(centrds, results[0][0])
+        assert clusters == results[0][1]
+        assert inertia == results[0][2]
+
+
+@pytest.mark.parametrize('workers', [1, 2, 3])
+def test_sharded_clusters_matches_create_clusters(workers):
+    points = make_points(num_points=1500, k=5)
+    initial = cluster.pick_initial_centroids(5, points, seed=0)
+    centrds, clusters = cluster.create_clusters(5, initial, points, 50)
+    sharded_centrds, sharded_clusters = cluster.sharded_clusters(5, initial, points, 50, workers=workers)
+    assert sharded_clusters == clusters
+    np.testing.assert_allclose(sharded_centrds, centrds, rtol=1e-12)
+
+
+def test_column_cache_matches_parsed_csv_and_rebuilds_on_change(tmp_path):
+    path = tmp_path / 'lifts.csv'
+    path.write_text('Calories,PRO (g),\n2800,175,\n3000,180,\n')
+    parsed, columns = cluster.load_points(str(path))
+    cached, cached_columns = cluster.load_points(str(path), cache=True)
+    assert cached_columns == columns
+    np.testing.assert_array_equal(cached, parsed)
+
+    # a new row changes the size of the .csv
+    path.write_text('Calories,PRO (g),\n2800,175,\n3000,180,\n2500,160,\n')
+    np.testing.assert_array_equal(cluster.load_points(str(path), cache=True)[0],
+                                  [[2800, 175], [3000, 180], [2500, 160]])
+
+    # an edit of the same size only changes the mtime
+    stat = path.stat()
+    path.write_text('Calories,PRO (g),\n2900,175,\n3000,180,\n2500,160,\n')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    np.testing.assert_array_equal(cluster.load_points(str(path), cache=True)[0],
+                                  [[2900, 175], [3000, 180], [2500, 160]])
+
+
+@pytest.mark.parametrize('options', [['--k-range', '2', '4', '--workers', '2'],
+                                     ['--k-range', '2', '4', '--restarts', '3'],
+                                     ['--backend', 'hamerly', '--workers', '2'],
+                                     ['--columns', 'Calories', 'PRO (g)', '--plot', 'never-written.png']])
+def test_main_rejects_options_it_would_ignore(options):
+    with pytest.raises(SystemExit):
+        cluster.main(['bulkData.csv'] + options)
+
+
+def test_sharded_clusters_uses_the_distance_kernel():
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(1000, 3)) + [3, 0, 0]
+    distance = cluster.make_distance('cosine')
+    initial = cluster.pick_initial_centroids(4, points, seed=0)
+    centrds, clusters = cluster.create_clusters(4, initial, points, 50, distance=distance)
+    sharded_centrds, sharded_clusters = cluster.sharded_clusters(4, initial, points, 50, workers=2, distance=distance)
+    assert sharded_clusters == clusters
+    np.testing.assert_allclose(sharded_centrds, centrds, rtol=1e-12)
+    assert sharded_clusters != cluster.create_clusters(4, initial, points, 50)[1]
+
+
+def test_update_clusters_keeps_state_exact():
+    points = make_points(num_points=6000, k=5, seed=4)
+    centrds, _ = cluster.create_clusters(5, cluster.pick_initial_centroids(5, points[:1000], seed=0), points[:1000], 50)
+    state = cluster.incremental_state(points[:1000], centrds)
+    for stop in range(1500, 6001, 500):
+        cluster.update_clusters(state, points[:stop])
+        labels = state['labels']
+        assert len(labels) == state['num_points'] == stop
+        np.testing.assert_array_equal(labels, cluster.assign_points(points[:stop], state['bounds_at'])[0])
+        np.testing.assert_array_equal(state['counts'], np.bincount(labels, minlength=5))
+        np.testing.assert_allclose(state['sums'], cluster.update_centroids(points[:stop], labels, 5)
+                                   * state['counts'][:, np.newaxis])
+    assert len(state['buffers'][0]) < 2 * 6000
+
+
+@pytest.mark.parametrize('empty', ['farthest', 'split'])
+def test_reseeding_fills_empty_clusters(empty):
+    points = make_points(num_points=1000, k=3, seed=5)
+    initial = np.repeat(points[:1], 3, axis=0)
+    centrds, clusters, history = cluster.create_clusters(3, initial, points, 100, empty=empty, return_history=True)
+    assert history[0]['reseeded'] == [1, 2]
+    assert all(clusters)
+    labels = cluster.assign_points(points, centrds)[0]
+    assert cluster.labels_to_clusters(labels, 3) == clusters
+
+
+@pytest.mark.parametrize('empty', ['farthest', 'split'])
+def test_clusters_match_centroids_when_iterations_end_on_a_reseed(empty):
+    points = make_points(num_points=1000, k=3, seed=5)
+    initial = np.repeat(points[:1], 3, axis=0)
+    centrds, clusters = cluster.create_clusters(3, initial, points, 1, empty=empty)
+    assert cluster.labels_to_clusters(cluster.assign_points(points, centrds)[0], 3) == clusters
+
+
+
+def test_visualize_clusters_draws_only_the_listed_points(tmp_path):
+    points = make_points(num_points=10, k=2)
+    points[5:] += 1000
+    fig = cluster.visualize_clusters(points[:2], [[0, 1, 2], [3, 4]], points, 'xyz', sphere=True,
+                                     save_path=str(tmp_path / 'clusters.png'))
+    drawn = np.concatenate([collection._offsets3d[0] for collection in fig.axes[0].collections
+                            if hasattr(collection, '_offsets3d')])
+    np.testing.assert_array_equal(np.sort(drawn), np.sort(points[:5, 0]))
+
+
+def test_make_distance_checks_the_weights():
+    for weights in ([1.0, -1.0, 1.0], [[1.0, 1.0, 1.0]], [], [1.0, np.nan, 1.0]):
+        with pytest.raises(ValueError):
+            cluster.make_distance('weighted', weights=weights)
+    with pytest.raises(ValueError):
+        cluster.assign_points(make_points(), make_points()[:2], distance=cluster.make_distance('weighted', [1.0, 2.0]))
+
+
+def test_coreset_clusters_uses_the_distance_kernel():
+    points = make_points(num_points=4000, k=4) + 100
+    distance = cluster.make_distance('cosine')
+    centrds, clusters, report = cluster.coreset_clusters(4, points, 500, seed=0, distance=distance)
+    labels, dists = cluster.assign_points(points, centrds, distance=distance)
+    assert cluster.labels_to_clusters(labels, 4) == clusters
+    assert report['inertia'] == pytest.approx(dists.sum())
+
+
+def test_cluster_model_save_load_round_trip(tmp_path):
+    points = make_points(k=3)
+    offset, scale = cluster.fit_scaler(points)
+    model = cluster.ClusterModel(points[:3], ['Calories', 'PRO (g)', 'Work Fraction'], offset, scale,
+                                 {'k': 3, 'inertia': 12.5})
+    path = str(tmp_path / 'model.npz')
+    model.save(path)
+    loaded = cluster.ClusterModel.load(path)
+    np.testing.assert_array_equal(loaded.centroids, model.centroids)
+    np.testing.assert_array_equal(loaded.offset, offset)
+    np.testing.assert_array_equal(loaded.scale, scale)
+    assert loaded.columns == model.columns
+    assert loaded.metadata == model.metadata
+
+
+def test_cluster_model_predict_matches_assign_points():
+    points = make_points(num_points=3000, k=4, seed=3) * [100, 1, 10]
+    offset, scale = cluster.fit_scaler(points)
+    scaled = cluster.scale_points(points.copy(), offset, scale)
+    centrds, _ = cluster.create_clusters(4, cluster.pick_initial_centroids(4, scaled, seed=0), scaled, 50)
+    model = cluster.ClusterModel(centrds, offset=offset, scale=scale)
+    np.testing.assert_array_equal(model.predict(points, chunk_rows=700), cluster.assign_points(scaled, centrds)[0])
+
+
+def test_fit_scaler_methods():
+    points = np.array([[1.0, 10.0], [2.0, 20.0], [3.0, 30.0], [4.0, 40.0], [10.0, 50.0]])
+    offset, scale = cluster.fit_scaler(points, 'zscore')
+    np.testing.assert_allclose(offset, points.mean(axis=0))
+    np.testing.assert_allclose(scale, points.std(axis=0))
+    offset, scale = cluster.fit_scaler(points, 'minmax')
+    np.testing.assert_allclose(offset, [1, 10])
+    np.testing.assert_allclose(scale, [9, 40])
+    offset, scale = cluster.fit_scaler(points, 'robust')
+    np.testing.assert_allclose(offset, [3, 30])
+    np.testing.assert_allclose(scale, [2, 20])
+    with pytest.raises(ValueError):
+        cluster.fit_scaler(points, 'log')
+
+
+@pytest.mark.parametrize('method', cluster.SCALING_METHODS)
+def test_constant_features_get_a_scale_of_one(method):
+    points = np.column_stack([np.full(5, 7.0), np.arange(5.0)])
+    offset, scale = cluster.fit_scaler(points, method)
+    assert scale[0] == 1
+    np.testing.assert_array_equal(cluster.scale_points(points.copy(), offset, scale)[:, 0], 0)
+
+
+@pytest.mark.parametrize('method', cluster.SCALING_METHODS)
+def test_unscale_points_inverts_scale_points(method):
+    points = make_points(seed=7) * [1000, 1, 0.01]
+    offset, scale = cluster.fit_scaler(points, method)
+    scaled = points.copy()
+    assert cluster.scale_points(scaled, offset, scale) is scaled
+    np.testing.assert_allclose(cluster.unscale_points(scaled, offset, scale), points)
+
+
+def test_profiling_records_stages_and_counters():
+    points = make_points()
+    initial = cluster.pick_initial_centroids(4, points, seed=0)
+    with cluster.profiling() as profiler:
+        _, _, history = cluster.create_clusters(4, initial, points, 50, return_history=True)
+    report = profiler.report()
+    assert report['timings']['assign']['calls'] == len(history)
+    assert report['timings']['update']['calls'] == len(history)
+    assert report['counters']['distance_evaluations'] == len(history) * len(points) * 4
+
+    # once profiling is off nothing more is recorded
+    assert cluster._profiler is None
+    cluster.create_clusters(4, initial, points, 50)
+    assert profiler.report() == report
+
+
+def test_create_clusters_stops_early_and_records_telemetry():
+    points = make_points()
+    initial = cluster.pick_initial_centroids(4, points, seed=0)
+    records = []
+    centrds, clusters, history = cluster.create_clusters(4, initial, points, 100, callback=records.append,
+                                                         return_history=True)
+    assert len(history) < 100
+    assert records == history
+    assert [record['iteration'] for record in history] == list(range(len(history)))
+    for record in history:
+        assert {'inertia', 'moved', 'shift', 'time'} <= set(record)
+        assert record['time'] >= 0
+    assert history[0]['moved'] == len(points)
+    assert history[-1]['shift'] == 0.0 and history[-1]['moved'] == 0
+    assert all(later['inertia'] <= earlier['inertia'] + 1e-9 for earlier, later in zip(history, history[1:]))
+    assert history[-1]['inertia'] == pytest.approx(cluster.assign_points(points, centrds)[1].sum())
+
+
+def test_create_clusters_stops_at_tol():
+    points = make_points()
+    initial = cluster.pick_initial_centroids(4, points, seed=0)
+    _, _, exact = cluster.create_clusters(4, initial, points, 100, return_history=True)
+    _, _, loose = cluster.create_clusters(4, initial, points, 100, tol=1e6, return_history=True)
+    assert len(loose) == 1 < len(exact)
+
+
+@pytest.mark.parametrize('method', cluster.SEEDING_METHODS)
+def test_seeding_is_reproducible(method):
+    points = make_points(num_points=2000, k=6)
+    first = cluster.pick_initial_centroids(6, points, method=method, seed=11)
+    np.testing.assert_array_equal(first, cluster.pick_initial_centroids(6, points, method=method, seed=11))
+    assert first.shape == (6, 3)
+    assert len({tuple(centroid) for centroid in first}) == 6
+    assert not np.array_equal(first, cluster.pick_initial_centroids(6, points, method=method, seed=12))
+
+
+def test_sweep_k_rows():
+    points = make_points(num_points=1500, k=4)
+    rows = cluster.sweep_k(points, [5, 2, 4, 3], 50, seed=0, silhouette_sample=300)
+    assert [row['k'] for row in rows] == [2, 3, 4, 5]
+    for row in rows:
+        assert row['centroids'].shape == (row['k'], 3)
+        assert row['inertia'] == pytest.approx(cluster.assign_points(points, row['centroids'])[1].sum())
+    assert max(rows, key=lambda row: row['silhouette'])['k'] == 4
+
+
+def test_silhouette_score_matches_brute_force():
+    points = make_points(num_points=60, k=3, seed=2)
+    labels = cluster.assign_points(points, points[:3])[0]
+    labels[0] = 2
+    dists = np.sqrt(((points[:, np.newaxis, :] - points[np.newaxis, :, :]) ** 2).sum(axis=2))
+    np.testing.assert_allclose(cluster._pairwise_dists(points), dists, atol=1e-9)
+
+    scores = []
+    for i in range(len(points)):
+        own = labels == labels[i]
+        if own.sum() == 1:
+            scores.append(0.0)
+            continue
+        a = dists[i, own].sum() / (own.sum() - 1)
+        b = min(dists[i, labels == other].mean() for other in set(labels.tolist()) - {labels[i]})
+        scores.append((b - a) / max(a, b))
+    assert cluster.silhouette_score(dists, labels, 3) == pytest.approx(np.mean(scores))
+
+
+@pytest.mark.parametrize('method', cluster.CORESET_METHODS)
+def test_coreset_clusters_close_to_exact_fit(method):
+    # on well separated blobs the approximate inertia stays within 5% of an exact fit
+    points = make_points(num_points=20000, k=4, seed=1)
+    centrds, _ = cluster.create_clusters(4, cluster.pick_initial_centroids(4, points, 'kmeans++', seed=0), points, 100)
+    exact_inertia = cluster.assign_points(points, centrds)[1].sum()
+
+    approx_centrds, clusters, report = cluster.coreset_clusters(4, points, 1000, method=method, seed=0)
+    assert sorted(np.concatenate(clusters).tolist()) == list(range(len(points)))
+    assert report['coreset_size'] < len(points) // 10
+    assert report['inertia'] == pytest.approx(cluster.assign_points(points, approx_centrds)[1].sum())
+    assert report['inertia'] <= 1.05 * exact_inertia
+
+
+@pytest.mark.parametrize('sampler', [cluster.lightweight_coreset,
+                                     lambda source, size, seed: cluster.sensitivity_coreset(source, 4, size, seed)])
+def test_coresets_are_seeded_and_weighted(sampler):
+    points = make_points(num_points=20000, k=4, seed=1)
+    coreset, weights = sampler(points, 1000, 0)
+    repeat, repeat_weights = sampler(points, 1000, 0)
+    np.testing.assert_array_equal(coreset, repeat)
+    np.testing.assert_array_equal(weights, repeat_weights)
+    assert np.all(weights >= 1)
+    # the weights are inverse inclusion probabilities, so they sum to about the number of points
+    assert weights.sum() == pytest.approx(len(points), rel=0.1)
+
+
+def test_update_clusters_reads_only_the_rows_it_needs():
+    points = make_points(num_points=3000, k=4, seed=6)
+    centrds, _ = cluster.create_clusters(4, cluster.pick_initial_centroids(4, points[:1000], seed=0), points[:1000], 50)
+    array_state = cluster.incremental_state(points[:1000], centrds)
+    list_state = cluster.incremental_state(points[:1000], centrds)
+
+    class Rows(list):
+        # a list of points that records which rows are read one at a time
+        read = set()
+
+        def __getitem__(self, index):
+            if not isinstance(index, slice):
+                self.read.add(index)
+            return super().__getitem__(index)
+
+    for stop in (1500, 2000, 3000):
+        rows = Rows(map(tuple, points[:stop]))
+        Rows.read = set()
+        report = cluster.update_clusters(list_state, rows)
+        assert report == cluster.update_clusters(array_state, points[:stop])
+        assert len(Rows.read) == report['rechecked'] < stop
+        np.testing.assert_array_equal(list_state['labels'], array_state['labels'])
+
+
+def test_beautify_data_skips_blank_lines(tmp_path):
+    path = tmp_path / 'lifts.csv'
+    path.write_text('Calories,PRO (g),\n2800,175,\n\n3000,180,\n\n')
+    with open(path) as fp:
+        data = cluster.beautify_data(fp)
+    assert data == {'Calories': ['2800', '3000'], 'PRO (g)': ['175', '180']}
+    with open('bulkData.csv') as fp:
+        assert len(cluster.build_point_list(cluster.beautify_data(fp))) == len(cluster.load_points('bulkData.csv')[0])